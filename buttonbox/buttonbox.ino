@@ -35,6 +35,29 @@ int ROTARY_ENCODER_STATE = HIGH;
 // Use for things like LEDs
 int OUTPUT_PINS[] = {4, 0, 2, 16};
 
+// Indexed like the LEDs in the binary protocol
+const int LED_PINS[] = {LED_LEFT_PIN, LED_MIDDLE_PIN, LED_RIGHT_PIN, LED_EXTRA_PIN};
+
+// Binary protocol, see client/buttonbox_client/protocol.py
+// Microcontroller -> Computer
+const uint8_t OP_BUTTONS = 0x80;  // 3 byte little endian bitmask
+const uint8_t OP_ROTARY_CLOCKWISE = 0x81;
+const uint8_t OP_ROTARY_COUNTERCLOCKWISE = 0x82;
+const uint8_t OP_BUTTON_CHANGE = 0x83;  // 1 byte, button bit in bits 0-4, state in bit 7
+// Computer -> Microcontroller
+const uint8_t OP_LED = 0x90;  // 1 byte, LED index in bits 0-1, state in bit 7
+const uint8_t OP_LED_SET = 0x91;  // 1 byte, state of every LED, bit = LED index
+
+// Enabled by the PROTOCOL BINARY task, reset by HANDSHAKE
+bool BINARY_PROTOCOL = false;
+
+// Set by the REPORT CHANGES <ms> task, reset by HANDSHAKE. With 0 the full
+// button state is reported on every loop pass, otherwise only changes are
+// reported, plus a full keyframe every REPORT_KEYFRAME_INTERVAL ms.
+unsigned long REPORT_KEYFRAME_INTERVAL = 0;
+unsigned long LAST_KEYFRAME = 0;
+unsigned long LAST_BUTTONS = 0;
+
 
 void resetDisplay() {
   display.clearDisplay();
@@ -48,12 +71,18 @@ void resetDisplay() {
 void execTask(String task);
 
 
+void execBinaryTask(int opcode);
+
+
 void pollButtonMatrix();
 
 
 void pollButtonSingle();
 
 
+void pollButtons();
+
+
 void pollRotaryEncoder();
 
 
@@ -104,11 +133,14 @@ void setup() {
 void loop() {
   while (true) {
     if (Serial.available() > 0) {
-      String receivedData = Serial.readStringUntil('\n');
-      execTask(receivedData);
+      if (BINARY_PROTOCOL && Serial.peek() >= 0x80) {
+        execBinaryTask(Serial.read());
+      } else {
+        String receivedData = Serial.readStringUntil('\n');
+        execTask(receivedData);
+      }
     }
-    pollButtonMatrix();
-    pollButtonSingle();
+    pollButtons();
     pollRotaryEncoder();
   }
 }
@@ -120,9 +152,17 @@ void pollRotaryEncoder() {
     ROTARY_ENCODER_STATE = newState;
     int dtValue = digitalRead(ROTARY_ENCODER_DT);
     if (newState == LOW && dtValue == HIGH) {
-      Serial.println("EVENT ROTARYENCODER CLOCKWISE");
+      if (BINARY_PROTOCOL) {
+        Serial.write(OP_ROTARY_CLOCKWISE);
+      } else {
+        Serial.println("EVENT ROTARYENCODER CLOCKWISE");
+      }
     } else if (newState == LOW && dtValue == LOW) {
-      Serial.println("EVENT ROTARYENCODER COUNTERCLOCKWISE");
+      if (BINARY_PROTOCOL) {
+        Serial.write(OP_ROTARY_COUNTERCLOCKWISE);
+      } else {
+        Serial.println("EVENT ROTARYENCODER COUNTERCLOCKWISE");
+      }
     }
   }
 }
@@ -164,6 +204,97 @@ void pollButtonSingle() {
 }
 
 
+// Matrix buttons in bits 0-17 (row * cols + col), single button in bit 18
+unsigned long readButtons() {
+  int rows = sizeof(BUTTON_MATRIX_PINS) / sizeof(BUTTON_MATRIX_PINS[0]);
+  int cols = sizeof(BUTTON_MATRIX_VOLTAGES) / sizeof(BUTTON_MATRIX_VOLTAGES[0]);
+
+  unsigned long mask = 0;
+  for (int i = 0; i < rows; i++) {
+    int val = analogRead(BUTTON_MATRIX_PINS[i]);
+    for (int j = 0; j < cols; j++) {
+      if (val >= BUTTON_MATRIX_VOLTAGES[j] - BUTTON_VOLTAGE_RANGE && val <= BUTTON_MATRIX_VOLTAGES[j] + BUTTON_VOLTAGE_RANGE) {
+        mask |= 1UL << (i * cols + j);
+      }
+    }
+  }
+  if (digitalRead(BUTTON_SINGLE_PIN) == HIGH) {
+    mask |= 1UL << (rows * cols);
+  }
+  return mask;
+}
+
+
+void sendButtonsBinary(unsigned long mask) {
+  uint8_t frame[] = {OP_BUTTONS, (uint8_t)(mask & 0xFF), (uint8_t)((mask >> 8) & 0xFF), (uint8_t)((mask >> 16) & 0xFF)};
+  Serial.write(frame, sizeof(frame));
+}
+
+
+void sendButtonsText(unsigned long mask) {
+  int rows = sizeof(BUTTON_MATRIX_PINS) / sizeof(BUTTON_MATRIX_PINS[0]);
+  int cols = sizeof(BUTTON_MATRIX_VOLTAGES) / sizeof(BUTTON_MATRIX_VOLTAGES[0]);
+
+  Serial.print("STATUS BUTTON MATRIX ");
+  for (int i = 0; i < rows; i++) {
+    for (int j = 0; j < cols; j++) {
+      Serial.print((mask >> (i * cols + j)) & 1 ? "1" : "0");
+      if (j != cols - 1) {
+        Serial.print(":");
+      }
+    }
+    Serial.print(";");
+  }
+  Serial.println();
+  Serial.print("STATUS BUTTON SINGLE ");
+  Serial.println((mask >> (rows * cols)) & 1 ? "1" : "0");
+}
+
+
+void sendButtonChange(int bit, int state) {
+  if (BINARY_PROTOCOL) {
+    uint8_t frame[] = {OP_BUTTON_CHANGE, (uint8_t)(bit | (state << 7))};
+    Serial.write(frame, sizeof(frame));
+  } else {
+    Serial.print("STATUS BUTTON CHANGE ");
+    Serial.print(bit);
+    Serial.println(state ? " 1" : " 0");
+  }
+}
+
+
+void pollButtons() {
+  if (REPORT_KEYFRAME_INTERVAL == 0) {
+    if (BINARY_PROTOCOL) {
+      sendButtonsBinary(readButtons());
+    } else {
+      pollButtonMatrix();
+      pollButtonSingle();
+    }
+    return;
+  }
+
+  unsigned long mask = readButtons();
+  unsigned long now = millis();
+  if (now - LAST_KEYFRAME >= REPORT_KEYFRAME_INTERVAL) {
+    if (BINARY_PROTOCOL) {
+      sendButtonsBinary(mask);
+    } else {
+      sendButtonsText(mask);
+    }
+    LAST_KEYFRAME = now;
+  } else {
+    unsigned long changed = mask ^ LAST_BUTTONS;
+    for (int bit = 0; changed != 0; bit++, changed >>= 1) {
+      if (changed & 1) {
+        sendButtonChange(bit, (mask >> bit) & 1);
+      }
+    }
+  }
+  LAST_BUTTONS = mask;
+}
+
+
 int parseLedPin(String str) {
   int pin;
   if (str.startsWith("LEFT")) {
@@ -208,8 +339,30 @@ void execDisplayTask(String task) {
 }
 
 
+// Bit i of mask is the state of LED_PINS[i]
+void setLeds(int mask) {
+  for (int i = 0; i < 4; i++) {
+    digitalWrite(LED_PINS[i], (mask >> i) & 1 ? HIGH : LOW);
+  }
+}
+
+
 void execLedTask(String task) {
-  if (task.startsWith("LED HIGH")) {
+  if (task.startsWith("LED SET")) {
+    // LED SET 1011, in the order LEFT MIDDLE RIGHT EXTRA
+    String states = task.substring(8, 12);
+    if (states.length() != 4) {
+      Serial.println("ERROR Invalid LED task '" + task + "'");
+      return;
+    }
+    int mask = 0;
+    for (int i = 0; i < 4; i++) {
+      if (states.charAt(i) == '1') {
+        mask |= 1 << i;
+      }
+    }
+    setLeds(mask);
+  } else if (task.startsWith("LED HIGH")) {
     int pin = parseLedPin(task.substring(9, 15));
     digitalWrite(pin, HIGH);
   } else if (task.startsWith("LED LOW")) {
@@ -221,9 +374,45 @@ void execLedTask(String task) {
 }
 
 
+void execBinaryTask(int opcode) {
+  if (opcode == OP_LED) {
+    uint8_t payload;
+    if (Serial.readBytes(&payload, 1) != 1) {
+      Serial.println("ERROR Incomplete binary LED task");
+      return;
+    }
+    digitalWrite(LED_PINS[payload & 0x03], (payload & 0x80) ? HIGH : LOW);
+  } else if (opcode == OP_LED_SET) {
+    uint8_t payload;
+    if (Serial.readBytes(&payload, 1) != 1) {
+      Serial.println("ERROR Incomplete binary LED SET task");
+      return;
+    }
+    setLeds(payload);
+  } else {
+    Serial.println("ERROR Invalid binary task 0x" + String(opcode, HEX));
+  }
+}
+
+
 void execTask(String task) {
   if (task.startsWith("HANDSHAKE")) {
+    // A new handshake means a (re)connected client, start over in text mode
+    BINARY_PROTOCOL = false;
+    REPORT_KEYFRAME_INTERVAL = 0;
     Serial.println("HANDSHAKE");
+  } else if (task.startsWith("PROTOCOL BINARY")) {
+    Serial.println("PROTOCOL BINARY");
+    BINARY_PROTOCOL = true;
+  } else if (task.startsWith("PROTOCOL TEXT")) {
+    BINARY_PROTOCOL = false;
+    Serial.println("PROTOCOL TEXT");
+  } else if (task.startsWith("REPORT CHANGES")) {
+    REPORT_KEYFRAME_INTERVAL = task.substring(15).toInt();
+    // Start with a keyframe
+    LAST_KEYFRAME = millis() - REPORT_KEYFRAME_INTERVAL;
+  } else if (task.startsWith("REPORT FULL")) {
+    REPORT_KEYFRAME_INTERVAL = 0;
   } else if (task.startsWith("DIGITAL HIGH")) {
     int num = task.substring(13).toInt();
     digitalWrite(num, HIGH);
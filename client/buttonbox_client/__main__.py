@@ -1,57 +1,278 @@
+import os
+import select
 import sys
 import time
 import traceback
-from collections import deque
 from pathlib import Path
 from threading import Thread
-from typing import Callable, Optional
+from typing import Callable, Optional, Sequence
 
 import pystray
 import serial
 from PIL import Image
 
 try:
-    from . import config
+    from . import capture, config, history, protocol
     from .gui import launch_gui
 except ImportError:
+    import capture  # type: ignore[no-redef]
     import config  # type: ignore[no-redef]
+    import history  # type: ignore[no-redef]
+    import protocol  # type: ignore[no-redef]
     from gui import launch_gui  # type: ignore[no-redef]
 
+# Upper bound for a single blocking read on the serial port. Where select() is
+# available queued writes wake the reader immediately.
+READ_TIMEOUT = 0.05
+# Without select() (Windows) nothing interrupts a blocking read, so queued
+# writes are picked up after at most this many seconds
+POLL_TIMEOUT = 0.01
+HANDSHAKE_TIMEOUT = 1.0
+# Most commands written with a single write(), so a long queue can't hold
+# back reading for too long
+MAX_WRITE_BATCH = 32
+
 
 class Connection:
     def __init__(
         self,
         port: str,
         baudrate: int,
-        log: Callable[[str, str], None],
+        log: Callable[..., None],
         log_mc: Callable[[str], None],
+        binary_protocol: bool = False,
+        keyframe_interval: int = 0,
+        write_queue_size: int = 256,
+        merge_led_commands: bool = True,
+        write_queue_overflow: str = protocol.OVERFLOW_DROP_OLDEST,
+        history_max_entries: int = 0,
+        history_max_bytes: int = 0,
     ) -> None:
         self.port = port
         self.baudrate = baudrate
+        # Whether to offer the binary protocol during the handshake, and
+        # whether the microcontroller accepted it
+        self.binary_requested = binary_protocol
+        self.binary = False
+        # Milliseconds between full button reports when the microcontroller
+        # only reports changes, 0 to have it report everything all the time
+        self.keyframe_interval = keyframe_interval
+        # Last known state of all buttons, see protocol.button_bit()
+        self.button_state = 0
         self.log = log
         self.log_mc = log_mc
         self.ser: Optional[serial.Serial] = None
         self.connected = False
         self.handshaked = False
-        self.write_queue: deque[str] = deque()
+        # Bounded, so a slow or missing device can't pile up commands
+        self.write_queue = protocol.CommandQueue(
+            write_queue_size, merge_led_commands, write_queue_overflow
+        )
+        # Last state sent for each LED, to skip writes that change nothing.
+        # Cleared whenever the microcontroller's state may differ from it.
+        self.led_state: dict[str, bool] = {}
+        # Whether the firmware accepts LED SET, older firmware rejects it and
+        # gets LED HIGH/LOW commands instead
+        self.led_set = True
+        # States of the last LED SET written, resent as single commands if
+        # the firmware rejects it
+        self.led_set_pending: Optional[str] = None
+
+        # Self-pipe used to interrupt select() when a command is queued
+        self._wakeup_r: Optional[int] = None
+        self._wakeup_w: Optional[int] = None
+        if os.name == "posix":
+            self._wakeup_r, self._wakeup_w = os.pipe()
+            os.set_blocking(self._wakeup_r, False)
+            os.set_blocking(self._wakeup_w, False)
 
         self.paused = False
-        self.in_history: list[str] = []
-        self.out_history: list[str] = []
-        self.full_history: list[str] = []
+        self.framer = protocol.LineFramer()
+        self.history = history.History(
+            history_max_entries, history_max_bytes
+        )
+        # Optionally also writes the history to disk
+        self.capture: Optional[capture.SerialCapture] = None
 
         self.rotary_encoder_clockwise: Callable[[], None] = lambda: None
         self.rotary_encoder_counterclockwise: Callable[[], None] = lambda: None
-        self.status_button_matrix: Callable[
-            [list[list[int]]], None] = lambda _: None
+        # Receives the pressed matrix buttons as bitmask
+        self.status_button_matrix: Callable[[int], None] = lambda _: None
         self.status_button_single: Callable[[int], None] = lambda _: None
         self.mc_debug: Callable[[str], None] = lambda _: None
         self.mc_warning: Callable[[str], None] = lambda _: None
         self.mc_error: Callable[[str], None] = lambda _: None
         self.mc_critical: Callable[[str], None] = lambda _: None
 
-    def write(self, cmd: str) -> None:
-        self.write_queue.append(cmd)
+    def write(self, cmd: str, priority: Optional[int] = None) -> None:
+        """
+        Queue `cmd` for writing. The priority class is derived from the
+        command unless given, see protocol.command_priority().
+        """
+        if cmd.startswith("LED "):
+            # Raw LED commands (e.g. from the serial monitor) are never
+            # dropped, but have to be reflected in the cache
+            parts = cmd.split()
+            if len(parts) == 3 and parts[1] in protocol.LED_STATES:
+                self.led_state[parts[2]] = parts[1] == "HIGH"
+            elif len(parts) == 3 and parts[1] == "SET":
+                for led, state in zip(protocol.LED_INDICES, parts[2]):
+                    self.led_state[led] = state == "1"
+        elif cmd.startswith("DIGITAL "):
+            # Might be an LED pin
+            self.led_state.clear()
+        dropped = self.write_queue.put(cmd, priority)
+        if dropped:
+            self.log(
+                f"Write queue full, dropped {dropped} "
+                f"({self.write_queue.stats()})", "WARNING"
+            )
+            if any(cmd.startswith("LED ") for cmd in dropped):
+                self.led_state.clear()
+        self._wakeup()
+
+    def set_led(self, led: str, state: bool) -> None:
+        """
+        Switch an LED ("LEFT", "MIDDLE", "RIGHT" or "EXTRA"), unless it's
+        already in that state.
+        """
+        if self.led_state.get(led) == state:
+            return
+        self.write(f"LED {'HIGH' if state else 'LOW'} {led}")
+
+    def set_leds(self, states: Sequence[Optional[bool]]) -> None:
+        """
+        Switch all LEDs with a single command. `states` is in the order of
+        protocol.LED_INDICES, None keeps an LED as it is.
+        """
+        merged = [
+            self.led_state.get(led) if state is None else state
+            for led, state in zip(protocol.LED_INDICES, states)
+        ]
+        if all(
+            self.led_state.get(led) == state
+            for led, state in zip(protocol.LED_INDICES, merged)
+        ):
+            return
+        if None in merged or not self.led_set:
+            # The state of some LEDs is unknown, so LED SET can't be used
+            for led, state in zip(protocol.LED_INDICES, states):
+                if state is not None:
+                    self.set_led(led, state)
+            return
+        self.led_set_pending = "".join(
+            "1" if state else "0" for state in merged
+        )
+        self.write("LED SET " + self.led_set_pending)
+
+    def _led_set_rejected(self) -> None:
+        """Switch to LED HIGH/LOW and resend the rejected LED states."""
+        if self.led_set:
+            self.led_set = False
+            self.log(
+                "Firmware doesn't support LED SET, falling back to single LED"
+                " commands. Update the firmware to switch LEDs at once.",
+                "WARNING",
+            )
+        # The cache holds the rejected states
+        self.led_state.clear()
+        pending, self.led_set_pending = self.led_set_pending, None
+        if pending is not None:
+            for led, state in zip(protocol.LED_INDICES, pending):
+                self.set_led(led, state == "1")
+
+    def clear_write_queue(self) -> None:
+        self.write_queue.clear()
+        # Dropped LED commands would leave the cache out of sync
+        self.led_state.clear()
+
+    def _wakeup(self) -> None:
+        if self._wakeup_w is None:
+            return
+        try:
+            os.write(self._wakeup_w, b"\0")
+        except BlockingIOError:
+            pass  # Pipe is full, the reader will wake up anyway
+
+    def _drain_wakeup(self) -> None:
+        if self._wakeup_r is None:
+            return
+        try:
+            while os.read(self._wakeup_r, 512):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _wait_for_data(self, timeout: float = READ_TIMEOUT) -> bytes:
+        """
+        Block until bytes arrive on the port, a write is queued or the timeout
+        expires. Returns all bytes available at that point, or b"".
+        """
+        assert self.ser is not None
+        if self._wakeup_r is not None and hasattr(self.ser, "fileno"):
+            readable, _, _ = select.select(
+                [self.ser.fileno(), self._wakeup_r], [], [], timeout
+            )
+            if self._wakeup_r in readable:
+                self._drain_wakeup()
+            if self.ser.fileno() not in readable:
+                return b""
+            data: bytes = self.ser.read(self.ser.in_waiting or 1)
+            return data
+        # We can't select() on the port (Windows), so block in read() for a
+        # short while and then take whatever else already arrived.
+        in_waiting = self.ser.in_waiting
+        if in_waiting or timeout <= 0:
+            return self.ser.read(in_waiting) if in_waiting else b""
+        timeout = min(timeout, POLL_TIMEOUT)
+        if self.ser.timeout != timeout:
+            self.ser.timeout = timeout
+        data = self.ser.read(1)
+        if data and (in_waiting := self.ser.in_waiting):
+            data += self.ser.read(in_waiting)
+        return data
+
+    def _await_line(
+        self, *prefixes: bytes, timeout: float = HANDSHAKE_TIMEOUT
+    ) -> Optional[bytes]:
+        """
+        Wait for a text line starting with one of `prefixes`, discarding
+        everything else. Returns None if none arrived within `timeout`.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                lines = self.framer.feed(self._wait_for_data())
+            except (
+                OSError, ValueError, serial.SerialException,
+                TypeError, AttributeError,
+            ) as e:
+                self.log(f"Error reading potential handshake: {e}",
+                         "WARNING")
+                time.sleep(READ_TIMEOUT)
+                continue
+            for line in lines:
+                if line.startswith(prefixes):
+                    return line
+        return None
+
+    def _negotiate_binary(self) -> None:
+        assert self.ser is not None
+        try:
+            self.ser.write(b"PROTOCOL BINARY\n")
+        except (
+            OSError, serial.SerialException,
+            TypeError, AttributeError,
+        ) as e:
+            self.log(f"Error requesting binary protocol: {e}", "WARNING")
+            return
+        # Firmware without binary support answers with an ERROR
+        reply = self._await_line(b"PROTOCOL BINARY", b"ERROR")
+        if reply is not None and reply.startswith(b"PROTOCOL BINARY"):
+            self.binary = True
+            self.log("Using binary protocol", "DEBUG")
+        else:
+            self.log("Binary protocol unsupported, using text", "DEBUG")
 
     def run(self) -> None:
         while True:
@@ -79,106 +300,112 @@ class Connection:
                 ) as e:
                     self.log(f"Error writing handshake: {e}", "WARNING")
                     continue
-                for _ in range(100):
-                    try:
-                        in_waiting = self.ser.in_waiting
-                    except (OSError, TypeError, AttributeError) as e:
-                        self.log(
-                            "Received error when checking for available "
-                            f"bytes: {e}",
-                            "WARNING",
-                        )
-                        continue
-                    if in_waiting > 0:
-                        try:
-                            msg = self.ser.read_until().decode("utf-8")
-                        except (
-                            OSError, serial.SerialException,
-                            TypeError, AttributeError,
-                        ) as e:
-                            self.log(f"Error reading potential handshake: {e}",
-                                     "WARNING")
-                            continue
-                        if msg.startswith(
-                            "HANDSHAKE"
-                        ):
-                            self.log(
-                                f"Received HANDSHAKE on port {self.ser.name}",
-                                "DEBUG"
-                            )
-                            self.handshaked = True
-                            break
-                    time.sleep(0.01)
-                else:
+                self.framer.reset()
+                self.binary = False
+                self.led_state.clear()
+                # Might be newer firmware than last time
+                self.led_set = True
+                self.led_set_pending = None
+                if self._await_line(b"HANDSHAKE") is None:
                     time.sleep(1)
+                    continue
+                self.log(
+                    "Received HANDSHAKE on port %s", "DEBUG", self.ser.name
+                )
+                if self.binary_requested:
+                    self._negotiate_binary()
+                self.button_state = 0
+                if self.keyframe_interval > 0:
+                    # Older firmware answers with an ERROR and keeps sending
+                    # full reports, which are handled just the same
+                    self.write(f"REPORT CHANGES {self.keyframe_interval}")
+                self.handshaked = True
                 continue
 
             # We are connected and got a handshake
 
-            while True:
-                if self.write_queue:
-                    cmd = self.write_queue.popleft()
-                    try:
-                        self.ser.write(cmd.encode("utf-8") + b"\n")
-                    except (
-                        OSError, serial.SerialException,
-                        TypeError, AttributeError,
-                    ) as e:
-                        self.log(f"Error writing '{cmd}': {e}", "WARNING")
-                        self.write_queue.append(cmd)
-                        continue
-                    self.log(f"Wrote {cmd} to port {self.ser.name}", "DEBUG")
-                    self.out_history.append(cmd)
-                    self.full_history.append(f"[OUT] {cmd}\n")
-                else:
-                    break
+            if self.write_queue:
+                self._flush_write_queue()
+
+            try:
+                # Don't block if there are still commands left to write
+                data = self._wait_for_data(
+                    0 if self.write_queue else READ_TIMEOUT
+                )
+            except (
+                OSError, ValueError, serial.SerialException,
+                TypeError, AttributeError,
+            ) as e:
+                self.log(f"Error waiting for serial data: {e}", "WARNING")
+                time.sleep(READ_TIMEOUT)
+                continue
 
-            while True:
+            for line in self.framer.feed(data):
+                if line and line[0] >= 0x80:
+                    text = protocol.describe_frame(line)
+                else:
+                    text = line
+                self.log(
+                    "Received %s from port %s", "DEBUG", text, self.ser.name
+                )
+                self.history.append(history.IN, text)
+                if self.capture:
+                    self.capture.record(
+                        history.PREFIXES[history.IN] + text + b"\n"
+                    )
                 try:
-                    in_waiting = self.ser.in_waiting
-                except (OSError, TypeError, AttributeError) as e:
+                    self.process_task(line)
+                except Exception as e:
                     self.log(
-                        "Received error when checking for available bytes: "
-                        f"{e}", "WARNING",
+                        f"Received invalid task {line!r} ({e})", "ERROR"
                     )
-                    break
-                if in_waiting > 0:
-                    try:
-                        line = self.ser.read_until().decode("utf-8")
-                    except (
-                        OSError, serial.SerialException,
-                        TypeError, AttributeError,
-                    ) as e:
-                        self.log(f"Error reading waiting bytes: {e}",
-                                 "WARNING")
-                        continue
-                    self.log(f"Received {line.replace('\n', '')} from port "
-                             f"{self.ser.name}", "DEBUG")
-                    self.in_history.append(line)
-                    # Double space for alignment with [OUT]
-                    self.full_history.append(f"[IN]  {line}")
-                    try:
-                        self.process_task(line)
-                    except Exception as e:
-                        self.log(
-                            f"Received invalid task {line.strip("\n")} ({e})",
-                            "ERROR"
-                        )
-                else:
-                    break
-            time.sleep(0.01)
+
+    def _flush_write_queue(self) -> None:
+        """Write up to MAX_WRITE_BATCH queued commands at once."""
+        assert self.ser is not None
+        batch = self.write_queue.take(MAX_WRITE_BATCH)
+        cmds = [cmd for _, cmd in batch]
+        try:
+            self.ser.write(b"".join(
+                protocol.encode_command(cmd, self.binary) for cmd in cmds
+            ))
+        except (
+            OSError, serial.SerialException,
+            TypeError, AttributeError,
+        ) as e:
+            self.log(f"Error writing {cmds}: {e}", "WARNING")
+            # Retry later, in the original order
+            self.write_queue.requeue(batch)
+            time.sleep(READ_TIMEOUT)
+            return
+        self.log("Wrote %s to port %s", "DEBUG", cmds, self.ser.name)
+        lines = [cmd.encode("utf-8") for cmd in cmds]
+        self.history.extend(history.OUT, lines)
+        if self.capture:
+            for line in lines:
+                self.capture.record(
+                    history.PREFIXES[history.OUT] + line + b"\n"
+                )
 
     def disconnect(self) -> None:
         self.connected = False
         self.handshaked = False
+        self.led_state.clear()
 
-    def process_task(self, line: str) -> None:
+    def process_task(self, line: bytes) -> None:
+        """
+        Dispatch a single line received from the microcontroller. The line is
+        only decoded for messages that are forwarded as text.
+        """
+        if line and line[0] >= 0x80:
+            self.process_frame(line)
+            return
         task = line.split()
         if not task:
             return
-        if task[0] == "EVENT":
-            if task[1] == "ROTARYENCODER":
-                if task[2] == "CLOCKWISE":
+        if task[0] == b"EVENT":
+            if task[1] == b"ROTARYENCODER":
+                if task[2] == b"CLOCKWISE":
                     self.log(
                         "Dispatching ROTARYENCODER CLOCKWISE Event", "DEBUG"
                     )
@@ -187,7 +414,7 @@ class Connection:
                     except Exception as e:
                         config.log(str(e), "CRITICAL")
                         traceback.print_exc(file=config.LogStream("TRACE"))
-                elif task[2] == "COUNTERCLOCKWISE":
+                elif task[2] == b"COUNTERCLOCKWISE":
                     self.log(
                         "Dispatching ROTARYENCODER COUNTERCLOCKWISE Event",
                         "DEBUG",
@@ -197,56 +424,112 @@ class Connection:
                     except Exception as e:
                         config.log(str(e), "CRITICAL")
                         traceback.print_exc(file=config.LogStream("TRACE"))
-        elif task[0] == "STATUS":
-            if task[1] == "BUTTON":
-                if task[2] == "MATRIX":
-                    status = task[3]
-                    matrix = []
-                    for row in status.split(";"):
-                        if "\n" in row or not row:
-                            continue
-                        matrix.append([int(i) for i in row.split(":")])
-                    try:
-                        self.status_button_matrix(matrix)
-                    except Exception as e:
-                        config.log(str(e), "CRITICAL")
-                        traceback.print_exc(file=config.LogStream("TRACE"))
-                elif task[2] == "SINGLE":
-                    state = task[3]
-                    try:
-                        self.status_button_single(int(state))
-                    except Exception as e:
-                        config.log(str(e), "CRITICAL")
-                        traceback.print_exc(file=config.LogStream("TRACE"))
-        elif task[0] == "DEBUG":
-            self.mc_debug(" ".join(task[1:]))
-            config.log_mc(line)
-        elif task[0] == "WARNING":
-            self.mc_warning(" ".join(task[1:]))
-            config.log_mc(line)
-        elif task[0] == "ERROR":
-            self.mc_error(" ".join(task[1:]))
-            config.log_mc(line)
-        elif task[0] == "CRITICAL":
-            self.mc_critical(" ".join(task[1:]))
-            config.log_mc(line)
+        elif task[0] == b"STATUS":
+            if task[1] == b"BUTTON":
+                if task[2] == b"MATRIX":
+                    mask = protocol.parse_text_matrix(task[3])
+                    self.button_state = (
+                        self.button_state & ~protocol.MATRIX_MASK | mask
+                    )
+                    self._dispatch_matrix()
+                elif task[2] == b"SINGLE":
+                    self._apply_button_change(
+                        protocol.SINGLE_BIT, int(task[3])
+                    )
+                elif task[2] == b"CHANGE":
+                    self._apply_button_change(int(task[3]), int(task[4]))
+        elif task[0] == b"DEBUG":
+            self.mc_debug(b" ".join(task[1:]).decode("utf-8", "replace"))
+            config.log_mc(line.decode("utf-8", "replace"))
+        elif task[0] == b"WARNING":
+            self.mc_warning(b" ".join(task[1:]).decode("utf-8", "replace"))
+            config.log_mc(line.decode("utf-8", "replace"))
+        elif task[0] == b"ERROR":
+            if line.startswith(protocol.LED_SET_REJECTED):
+                self._led_set_rejected()
+            self.mc_error(b" ".join(task[1:]).decode("utf-8", "replace"))
+            config.log_mc(line.decode("utf-8", "replace"))
+        elif task[0] == b"CRITICAL":
+            self.mc_critical(b" ".join(task[1:]).decode("utf-8", "replace"))
+            config.log_mc(line.decode("utf-8", "replace"))
         else:
-            self.log(f"Received invalid task {line.strip("\n")}", "ERROR")
+            self.log(f"Received invalid task {line!r}", "ERROR")
+
+    def process_frame(self, frame: bytes) -> None:
+        """Dispatch a single binary frame (see protocol.py)."""
+        opcode = frame[0]
+        if opcode == protocol.OP_BUTTONS:
+            self.button_state = int.from_bytes(frame[1:4], "little")
+            self._dispatch_matrix()
+            self._dispatch_single()
+        elif opcode == protocol.OP_BUTTON_CHANGE:
+            self._apply_button_change(frame[1] & 0x1F, frame[1] >> 7)
+        elif opcode == protocol.OP_ROTARY_CLOCKWISE:
+            self.log("Dispatching ROTARYENCODER CLOCKWISE Event", "DEBUG")
+            try:
+                self.rotary_encoder_clockwise()
+            except Exception as e:
+                config.log(str(e), "CRITICAL")
+                traceback.print_exc(file=config.LogStream("TRACE"))
+        elif opcode == protocol.OP_ROTARY_COUNTERCLOCKWISE:
+            self.log(
+                "Dispatching ROTARYENCODER COUNTERCLOCKWISE Event", "DEBUG"
+            )
+            try:
+                self.rotary_encoder_counterclockwise()
+            except Exception as e:
+                config.log(str(e), "CRITICAL")
+                traceback.print_exc(file=config.LogStream("TRACE"))
+        else:
+            self.log(f"Received invalid frame {frame.hex()}", "ERROR")
+
+    def _apply_button_change(self, bit: int, state: int) -> None:
+        if state:
+            self.button_state |= 1 << bit
+        else:
+            self.button_state &= ~(1 << bit)
+        if bit == protocol.SINGLE_BIT:
+            self._dispatch_single()
+        else:
+            self._dispatch_matrix()
+
+    def _dispatch_matrix(self) -> None:
+        try:
+            self.status_button_matrix(
+                self.button_state & protocol.MATRIX_MASK
+            )
+        except Exception as e:
+            config.log(str(e), "CRITICAL")
+            traceback.print_exc(file=config.LogStream("TRACE"))
+
+    def _dispatch_single(self) -> None:
+        try:
+            self.status_button_single(
+                (self.button_state >> protocol.SINGLE_BIT) & 1
+            )
+        except Exception as e:
+            config.log(str(e), "CRITICAL")
+            traceback.print_exc(file=config.LogStream("TRACE"))
 
     def connect(self) -> bool:
         try:
-            self.ser = serial.Serial(self.port, self.baudrate)
+            self.ser = serial.Serial(
+                self.port, self.baudrate, timeout=READ_TIMEOUT
+            )
             self.connected = True
             self.log(f"Connected to port {self.ser.name}", "DEBUG")
         except serial.SerialException as e:
             self.connected = False
             self.log(f"Failed to connect to serial port ({e})", "DEBUG")
         self.handshaked = False
+        self.led_state.clear()
         return self.connected
 
     def close(self) -> None:
         if self.ser:
             self.ser.close()
+        # Don't leave the serial thread blocked on a closed port
+        self._wakeup()
 
     def reconnect(self) -> bool:
         self.close()
@@ -259,7 +542,29 @@ def main() -> None:
     config.log(f"Default port: {port}", "INFO")
     baudrate = config.get_config_value("baudrate")
     config.log(f"Using baudrate {baudrate}", "INFO")
-    conn = Connection(port, baudrate, config.log, config.log_mc)
+    binary_protocol = config.get_config_value("binary_protocol")
+    config.log(f"Binary protocol: {binary_protocol}", "INFO")
+    keyframe_interval = config.get_config_value("report_keyframe_interval")
+    write_queue_size = config.get_config_value("write_queue_size")
+    merge_led_commands = config.get_config_value("merge_led_commands")
+    write_queue_overflow = config.get_config_value("write_queue_overflow")
+    history_max_entries = config.get_config_value("history_max_entries")
+    history_max_bytes = config.get_config_value("history_max_bytes")
+    conn = Connection(
+        port, baudrate, config.log, config.log_mc, binary_protocol,
+        keyframe_interval, write_queue_size, merge_led_commands,
+        write_queue_overflow, history_max_entries, history_max_bytes,
+    )
+    if config.get_config_value("serial_capture"):
+        config.log(f"Capturing serial traffic to {config.SER_CAPTURE_DIR}",
+                   "INFO")
+        conn.capture = capture.SerialCapture(
+            config.SER_CAPTURE_DIR,
+            config.get_config_value("serial_capture_segment_size"),
+            config.get_config_value("serial_capture_segments"),
+            config.log,
+        )
+        conn.capture.start()
     config.log("Launching GUI...", "INFO")
     app, win = launch_gui(conn)
     tray_icon = Image.open(Path(__file__).parent / "icons" / "cube-icon.png")
@@ -270,6 +575,8 @@ def main() -> None:
     def quit_app(icon) -> None:  # type: ignore[no-untyped-def]
         config.log("Received QUIT signal from tray icon", "INFO")
         conn.close()
+        if conn.capture:
+            conn.capture.stop()
         win.close()
         app.quit()
         icon.stop()
@@ -304,6 +611,8 @@ def main() -> None:
 
     icon.stop()
     conn.close()
+    if conn.capture:
+        conn.capture.stop()
     sys.exit(code)
 
 
@@ -0,0 +1,201 @@
+"""
+Append-only capture of the serial traffic on disk.
+
+Lines are written to segment files named after the timestamp of their first
+line, each line prefixed with its timestamp in nanoseconds. The timestamps
+come from time.monotonic_ns(), shifted by the wall clock once at startup, so
+they never go backwards while the client runs but can still be compared
+across restarts. Next to every segment an index file holds a (timestamp,
+offset) pair for about every INDEX_INTERVAL bytes, to find the start of a
+time range without scanning the whole segment.
+"""
+
+import mmap
+import queue
+import struct
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+from typing import BinaryIO, Callable, Optional
+
+# Seconds between writes, lines are collected and written in one go
+FLUSH_INTERVAL = 0.2
+INDEX_INTERVAL = 64 * 1024
+INDEX_ENTRY = struct.Struct("<qq")
+SEGMENT_SUFFIX = ".log"
+INDEX_SUFFIX = ".idx"
+
+
+class SerialCapture:
+    def __init__(
+        self,
+        directory: Path,
+        segment_size: int,
+        segments: int,
+        log: Callable[[str, str], None],
+    ) -> None:
+        self.directory = directory
+        # A segment is closed once it reaches this many bytes
+        self.segment_size = segment_size
+        # Number of segments to keep, older ones are deleted. 0 keeps all.
+        self.segments = segments
+        self.log = log
+        self.clock_offset = time.time_ns() - time.monotonic_ns()
+        self.queue: queue.SimpleQueue[tuple[int, bytes]] = queue.SimpleQueue()
+        self.segment: Optional[Path] = None
+        self.segment_fp: Optional[BinaryIO] = None
+        self.index_fp: Optional[BinaryIO] = None
+        self.written = 0
+        self.next_index = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self._run, name="buttonbox_capture", daemon=True
+        )
+
+    def now(self) -> int:
+        return time.monotonic_ns() + self.clock_offset
+
+    def start(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Write everything still queued and close the segment."""
+        if not self.thread.is_alive():
+            return
+        self.stopped.set()
+        self.thread.join()
+
+    def record(self, line: bytes) -> None:
+        """Queue a history line (ending with a newline) for writing."""
+        self.queue.put((self.now(), line))
+
+    def _run(self) -> None:
+        while True:
+            stopping = self.stopped.wait(FLUSH_INTERVAL)
+            batch: list[tuple[int, bytes]] = []
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self._write(batch)
+                except OSError as e:
+                    self.log(f"Error writing serial capture: {e}", "WARNING")
+                    self._close_segment()
+            if stopping:
+                break
+        self._close_segment()
+
+    def _write(self, batch: list[tuple[int, bytes]]) -> None:
+        data = bytearray()
+        index = bytearray()
+        for timestamp, line in batch:
+            if self.segment_fp is None or self.written >= self.segment_size:
+                self._flush(data, index)
+                self._open_segment(timestamp)
+            if self.written >= self.next_index:
+                index += INDEX_ENTRY.pack(timestamp, self.written)
+                self.next_index = self.written + INDEX_INTERVAL
+            record = b"%d " % timestamp + line
+            data += record
+            self.written += len(record)
+        self._flush(data, index)
+
+    def _flush(self, data: bytearray, index: bytearray) -> None:
+        if self.segment_fp is None or self.index_fp is None:
+            return
+        self.segment_fp.write(data)
+        self.index_fp.write(index)
+        # Make the batch visible to export()
+        self.segment_fp.flush()
+        self.index_fp.flush()
+        data.clear()
+        index.clear()
+
+    def _open_segment(self, timestamp: int) -> None:
+        self._close_segment()
+        self.segment = self.directory / f"{timestamp:020d}{SEGMENT_SUFFIX}"
+        self.segment_fp = open(self.segment, "ab")
+        self.index_fp = open(
+            self.segment.with_suffix(INDEX_SUFFIX), "ab"
+        )
+        self.written = 0
+        self.next_index = 0
+        if not self.segments:
+            return
+        for old in list_segments(self.directory)[:-self.segments]:
+            old.unlink(missing_ok=True)
+            old.with_suffix(INDEX_SUFFIX).unlink(missing_ok=True)
+
+    def _close_segment(self) -> None:
+        for fp in (self.segment_fp, self.index_fp):
+            if fp is not None:
+                try:
+                    fp.close()
+                except OSError:
+                    pass
+        self.segment_fp = None
+        self.index_fp = None
+
+    def export(self, start: int, end: int) -> list[bytes]:
+        """
+        History lines recorded from timestamp `start` to `end`, including
+        those of earlier runs still on disk.
+        """
+        lines: list[bytes] = []
+        segments = list_segments(self.directory)
+        for i, segment in enumerate(segments):
+            if int(segment.stem) > end:
+                break
+            if i + 1 < len(segments) and int(segments[i + 1].stem) < start:
+                continue  # Ends before the range
+            try:
+                lines.extend(_export_segment(segment, start, end))
+            except (OSError, ValueError):
+                # Deleted by rotation in the meantime or cut off mid-write
+                continue
+        return lines
+
+
+def list_segments(directory: Path) -> list[Path]:
+    """All segments, oldest first. Other files in `directory` are ignored."""
+    return sorted(
+        path for path in directory.glob(f"*{SEGMENT_SUFFIX}")
+        if path.stem.isdigit()
+    )
+
+
+def _export_segment(segment: Path, start: int, end: int) -> list[bytes]:
+    offset = 0
+    try:
+        index = segment.with_suffix(INDEX_SUFFIX).read_bytes()
+    except OSError:
+        index = b""
+    usable = len(index) - len(index) % INDEX_ENTRY.size
+    entries = list(INDEX_ENTRY.iter_unpack(index[:usable]))
+    # Last indexed line before `start`
+    pos = bisect_left([timestamp for timestamp, _ in entries], start) - 1
+    if pos >= 0:
+        offset = entries[pos][1]
+
+    lines: list[bytes] = []
+    with open(segment, "rb") as fp:
+        if not fp.seek(0, 2):
+            return lines  # Can't mmap an empty file
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            while offset < len(data):
+                line_end = data.find(b"\n", offset)
+                if line_end < 0:
+                    break  # Still being written
+                space = data.find(b" ", offset, line_end)
+                timestamp = int(data[offset:space])
+                if timestamp > end:
+                    break
+                if timestamp >= start:
+                    lines.append(data[space + 1:line_end + 1])
+                offset = line_end + 1
+    return lines
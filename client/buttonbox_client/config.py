@@ -1,8 +1,17 @@
+import atexit
+import gzip
 import json
+import os
 import platform
+import queue
+import shutil
+import threading
+import time
+import traceback
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Optional, Union
+from typing import IO, Any, Callable, Iterator, Optional, Union
 
 from PyQt6.QtCore import QStandardPaths
 
@@ -15,6 +24,7 @@ CONFIG_PATH = CONFIG_DIR / "config.json"
 LOGGER_PATH = CONFIG_DIR / "latest.log"
 MC_DEBUG_LOG_PATH = CONFIG_DIR / "mcdebug.log"
 SER_HISTORY_PATH = CONFIG_DIR / "serial_history.log"
+SER_CAPTURE_DIR = CONFIG_DIR / "serial_capture"
 PROFILES_PATH = CONFIG_DIR / "profiles.json"
 KEYBOARD_SHORTCUTS_PATH = CONFIG_DIR / "keyboard_shortcuts.json"
 CUSTOM_ACTIONS_PATH = CONFIG_DIR / "custom_actions.json"
@@ -33,8 +43,58 @@ DEFAULT_CONFIG = {
     "rotary_encoder_debounce_time": 0.0,
     "auto_detect_profiles": True,
     "hide_to_tray": True,
+    "binary_protocol": True,
+    "report_keyframe_interval": 1000,
+    "write_queue_size": 256,
+    "merge_led_commands": True,
+    "write_queue_overflow": "drop_oldest",
+    # 0 for no limit
+    "history_max_entries": 10000,
+    "history_max_bytes": 1000000,
+    "serial_capture": False,
+    "serial_capture_segment_size": 4000000,
+    "serial_capture_segments": 10,  # 0 keeps all
+    "log_level": "INFO",
+    "log_max_bytes": 5000000,
+    "log_max_age": 24,  # Hours
+    "log_max_archives": 5,
+    # Stopping a macro taking longer than this many milliseconds is logged
+    # as a warning
+    "macro_stop_latency": 1,
+    # Milliseconds between keys of type_text and key_sequence macro actions,
+    # unless the action sets its own interval
+    "macro_key_interval": 10,
+    # Commands of "command" buttons, 0 for no limit
+    "command_max_running": 0,
+    "command_max_per_button": 0,
+    "command_timeout": 0,  # Seconds
+    # Bytes of output kept per command, 0 to discard it
+    "command_output_bytes": 4096,
 }
 
+# Log lines are written by a background thread once this many are queued or
+# after this many seconds, whichever comes first
+LOG_FLUSH_SIZE = 256
+LOG_FLUSH_INTERVAL = 0.5
+
+LOG_LEVELS = {
+    "DEBUG": 10,
+    "INFO": 20,
+    "WARNING": 30,
+    "ERROR": 40,
+    "TRACE": 40,  # Tracebacks of errors
+    "CRITICAL": 50,
+}
+# Messages below this level are discarded, see set_log_level()
+log_level = LOG_LEVELS["INFO"]
+
+# (path, level, timestamp, message, args), level None for the microcontroller
+# log. An Event asks the writer for a flush and is set once it's done.
+LOG_ITEM = Union[
+    tuple[Path, Optional[str], float, str, tuple[object, ...]],
+    threading.Event,
+]
+
 MACRO_ACTION = dict[str, Optional[Union[str, int]]]
 MACRO = dict[str, Union[str, int, list[MACRO_ACTION]]]
 
@@ -91,6 +151,11 @@ def init_config() -> None:
         with open(CONFIG_PATH, "w", encoding="utf-8") as fp:
             json.dump(DEFAULT_CONFIG, fp)
 
+    observe_config_value("log_level", set_log_level)
+    LOG_WRITER.max_bytes = get_config_value("log_max_bytes")
+    LOG_WRITER.max_age = get_config_value("log_max_age") * 3600
+    LOG_WRITER.max_archives = get_config_value("log_max_archives")
+
 
 def _get_config() -> dict[str, Any]:
     with open(CONFIG_PATH, "r", encoding="utf-8") as fp:
@@ -98,50 +163,247 @@ def _get_config() -> dict[str, Any]:
     return conf
 
 
+def _write_json_atomic(path: Path, data: Any) -> None:
+    """
+    Write `data` to a temporary file first and move it over `path`, so a
+    crash can't leave a half written file behind.
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as fp:
+        json.dump(data, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+
 def _overwrite_config(config: dict[str, Any]) -> None:
-    with open(CONFIG_PATH, "w", encoding="utf-8") as fp:
-        json.dump(config, fp)
+    _write_json_atomic(CONFIG_PATH, config)
+
+
+class ConfigCache:
+    """
+    The contents of config.json, read once and then only again when the
+    file changes. Observers are called with the new value whenever a value
+    changes, whether through set() or an edit of the file.
+    """
+
+    # Seconds between checks whether the file changed
+    CHECK_INTERVAL = 1.0
+    # Seconds a debounced save waits for more changes
+    SAVE_DELAY = 1.0
+
+    def __init__(self) -> None:
+        self.values: dict[str, Any] = {}
+        self.mtime_ns: Optional[int] = None
+        self.next_check = 0.0
+        self.observers: dict[str, list[Callable[[Any], None]]] = {}
+        # Debounced save that hasn't happened yet
+        self.pending_save: Optional[threading.Timer] = None
+        # The debounced save runs in its own thread
+        self.lock = threading.RLock()
+
+    def get(self, key: str) -> Any:
+        now = time.monotonic()
+        if now >= self.next_check:
+            self.next_check = now + self.CHECK_INTERVAL
+            self.check()
+        try:
+            return self.values[key]
+        except KeyError:
+            return DEFAULT_CONFIG[key]
+
+    def set(self, key: str, value: Any, debounce: bool = False) -> None:
+        self.update({key: value}, debounce)
+
+    def update(self, values: dict[str, Any], debounce: bool = False) -> None:
+        """
+        Change several values and save them at once. With `debounce`, the
+        save waits SAVE_DELAY seconds for further changes.
+        """
+        with self.lock:
+            self.check()
+            changed = {
+                key: value for key, value in values.items()
+                if value != self.get(key)
+            }
+            self.values.update(values)
+            if debounce:
+                if self.pending_save is None:
+                    self.pending_save = threading.Timer(
+                        self.SAVE_DELAY, self.save
+                    )
+                    self.pending_save.daemon = True
+                    self.pending_save.start()
+            else:
+                self.save()
+        for key, value in changed.items():
+            self._notify(key, value)
+
+    @contextmanager
+    def transaction(self) -> Iterator[dict[str, Any]]:
+        """
+        Collect changes in the yielded dict and apply them together with
+        update() at the end, or not at all if an exception is raised.
+        """
+        changes: dict[str, Any] = {}
+        yield changes
+        self.update(changes)
+
+    def save(self) -> None:
+        with self.lock:
+            if self.pending_save is not None:
+                self.pending_save.cancel()
+                self.pending_save = None
+            _overwrite_config(self.values)
+            self.mtime_ns = os.stat(CONFIG_PATH).st_mtime_ns
+
+    def flush(self) -> None:
+        """Save now if a debounced save is pending."""
+        if self.pending_save is not None:
+            self.save()
+
+    def observe(self, key: str, callback: Callable[[Any], None]) -> None:
+        """Call `callback` with the value of `key`, now and on changes."""
+        # Read first, the initial load would notify the callback already
+        value = self.get(key)
+        self.observers.setdefault(key, []).append(callback)
+        callback(value)
+
+    def check(self) -> None:
+        """Reload if the file changed."""
+        if self.pending_save is not None:
+            return  # Would lose the unsaved changes
+        try:
+            mtime_ns = os.stat(CONFIG_PATH).st_mtime_ns
+        except OSError:
+            return
+        if mtime_ns != self.mtime_ns:
+            self.reload()
+
+    def reload(self) -> None:
+        try:
+            mtime_ns = os.stat(CONFIG_PATH).st_mtime_ns
+            values = _get_config()
+        except (OSError, ValueError) as e:
+            # E.g. written by an editor just now, keep the old values
+            log(f"Failed to load config ({e})", "WARNING")
+            return
+        with self.lock:
+            old = self.values
+            self.values = values
+            self.mtime_ns = mtime_ns
+        for key in self.observers:
+            value = values.get(key, DEFAULT_CONFIG.get(key))
+            if value != old.get(key, DEFAULT_CONFIG.get(key)):
+                self._notify(key, value)
+
+    def _notify(self, key: str, value: Any) -> None:
+        for callback in self.observers.get(key, []):
+            try:
+                callback(value)
+            except Exception:
+                traceback.print_exc(file=LogStream("TRACE"))
+
+
+CONFIG = ConfigCache()
+atexit.register(CONFIG.flush)
 
 
 def get_config_value(key: str) -> Any:
-    try:
-        val = _get_config()[key]
-    except KeyError:
-        val = DEFAULT_CONFIG[key]
-    return val
+    return CONFIG.get(key)
+
+
+def set_config_value(
+    key: str, value: Union[str, int, float, bool], debounce: bool = False
+) -> None:
+    CONFIG.set(key, value, debounce)
+
+
+@contextmanager
+def config_transaction() -> Iterator[dict[str, Any]]:
+    """
+    Change several values at once, writing the file only once:
+
+        with config_transaction() as changes:
+            changes["baudrate"] = 9600
+    """
+    with CONFIG.transaction() as changes:
+        yield changes
+
+
+def observe_config_value(key: str, callback: Callable[[Any], None]) -> None:
+    CONFIG.observe(key, callback)
+
+
+def check_config() -> None:
+    CONFIG.check()
 
 
-def set_config_value(key: str, value: Union[str, int, float, bool]) -> None:
-    config = _get_config()
-    config[key] = value
-    _overwrite_config(config)
+class ShortcutStore:
+    """
+    The keyboard shortcuts, indexed by (game, action). Read once and then
+    only again when the file changes.
+    """
+
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self) -> None:
+        self.shortcuts: dict[tuple[str, str], str] = {}
+        self.mtime_ns: Optional[int] = None
+        self.next_check = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, game: str, action: str) -> Optional[str]:
+        now = time.monotonic()
+        if now >= self.next_check:
+            self.next_check = now + self.CHECK_INTERVAL
+            self.check()
+        return self.shortcuts.get((game, action))
+
+    def check(self) -> None:
+        """Reload if the file changed."""
+        try:
+            mtime_ns = os.stat(KEYBOARD_SHORTCUTS_PATH).st_mtime_ns
+            if mtime_ns == self.mtime_ns:
+                return
+            with open(KEYBOARD_SHORTCUTS_PATH, "r", encoding="utf-8") as fp:
+                entries: list[dict[str, str]] = json.load(fp)
+        except (OSError, ValueError) as e:
+            log(f"Failed to load keyboard shortcuts ({e})", "WARNING")
+            return
+        with self.lock:
+            self.shortcuts = {
+                (entry["game"], entry["action"]): entry["shortcut"]
+                for entry in entries
+            }
+            self.mtime_ns = mtime_ns
+
+    def update(self, shortcuts: dict[tuple[str, str], str]) -> None:
+        """Change several shortcuts, writing the file once."""
+        self.check()
+        with self.lock:
+            self.shortcuts.update(shortcuts)
+            _write_json_atomic(KEYBOARD_SHORTCUTS_PATH, [
+                {"game": game, "action": action, "shortcut": shortcut}
+                for (game, action), shortcut in self.shortcuts.items()
+            ])
+            self.mtime_ns = os.stat(KEYBOARD_SHORTCUTS_PATH).st_mtime_ns
+
+
+SHORTCUTS = ShortcutStore()
 
 
 def get_keyboard_shortcut(game: str, action: str) -> Optional[str]:
-    with open(KEYBOARD_SHORTCUTS_PATH, "r", encoding="utf-8") as fp:
-        shortcuts: list[dict[str, str]] = json.load(fp)
-    for shortcut in shortcuts:
-        if shortcut["game"] == game and shortcut["action"] == action:
-            return shortcut["shortcut"]
-    return None
+    return SHORTCUTS.get(game, action)
 
 
 def set_keyboard_shortcut(game: str, action: str, shortcut: str) -> None:
-    with open(KEYBOARD_SHORTCUTS_PATH, "r", encoding="utf-8") as fp:
-        shortcuts: list[dict[str, str]] = json.load(fp)
-    exists = False
-    for entry in shortcuts:
-        if entry["game"] == game and entry["action"] == action:
-            exists = True
-            entry["shortcut"] = shortcut
-    if not exists:
-        shortcuts.append({
-            "game": game,
-            "action": action,
-            "shortcut": shortcut
-        })
-    with open(KEYBOARD_SHORTCUTS_PATH, "w", encoding="utf-8") as fp:
-        json.dump(shortcuts, fp)
+    SHORTCUTS.update({(game, action): shortcut})
+
+
+def set_keyboard_shortcuts(shortcuts: dict[tuple[str, str], str]) -> None:
+    """Change shortcuts, keyed by (game, action), writing the file once."""
+    SHORTCUTS.update(shortcuts)
 
 
 def get_custom_actions() -> dict[str, str]:
@@ -166,14 +428,191 @@ def set_macros(macros: list[MACRO]) -> None:
         json.dump(macros, fp)
 
 
-def log(msg: str, level: str = "INFO") -> None:
-    with open(LOGGER_PATH, "a", encoding="utf-8") as fp:
-        fp.write(f"[{level}] [{datetime.now().isoformat()}] {msg}\n")
+class LogWriter:
+    """
+    Appends log lines to their files from a background thread, in batches,
+    so logging doesn't cost a file open and close per message.
+    """
+
+    def __init__(self) -> None:
+        self.queue: queue.SimpleQueue[LOG_ITEM] = queue.SimpleQueue()
+        self.files: dict[Path, IO[str]] = {}
+        # time.monotonic() when each file was opened
+        self.opened: dict[Path, float] = {}
+        # A file is archived once it's this big or old, 0 to never archive.
+        # Only `max_archives` archives are kept per file.
+        self.max_bytes = 0
+        self.max_age = 0.0
+        self.max_archives = 0
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+
+    def put(
+        self,
+        path: Path,
+        level: Optional[str],
+        msg: str,
+        args: tuple[object, ...] = (),
+    ) -> None:
+        if self.thread is None:
+            self._start()
+        self.queue.put((path, level, time.time(), msg, args))
+
+    def _start(self) -> None:
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(
+                target=self._run, name="buttonbox_log", daemon=True
+            )
+            self.thread.start()
+
+    def flush(self, timeout: float = 2.0) -> None:
+        """Wait until everything logged so far is written."""
+        if self.thread is None or not self.thread.is_alive():
+            return
+        flushed = threading.Event()
+        self.queue.put(flushed)
+        flushed.wait(timeout)
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+            while (
+                len(batch) < LOG_FLUSH_SIZE
+                and not isinstance(batch[-1], threading.Event)
+            ):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception:
+                # Nowhere left to report this
+                pass
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _write(self, batch: list[LOG_ITEM]) -> None:
+        lines: dict[Path, list[str]] = {}
+        for item in batch:
+            if isinstance(item, threading.Event):
+                continue
+            path, level, timestamp, msg, args = item
+            if args:
+                msg = format_log_message(msg, args)
+            stamp = datetime.fromtimestamp(timestamp).isoformat()
+            if level is None:
+                line = f"[{stamp}] {msg}\n"
+            else:
+                line = f"[{level}] [{stamp}] {msg}\n"
+            lines.setdefault(path, []).append(line)
+        for path, path_lines in lines.items():
+            fp = self.files.get(path)
+            if fp is None:
+                fp = self.files[path] = open(path, "a", encoding="utf-8")
+                self.opened[path] = time.monotonic()
+            fp.writelines(path_lines)
+            fp.flush()
+            if (
+                self.max_bytes and fp.tell() >= self.max_bytes
+                or self.max_age
+                and time.monotonic() - self.opened[path] >= self.max_age
+            ):
+                self._rotate(path)
+
+    def _rotate(self, path: Path) -> None:
+        """Start a new file at `path` and compress the old one."""
+        self.files.pop(path).close()
+        del self.opened[path]
+        archive = path.with_name(
+            f"{path.stem}.{datetime.now():%Y%m%d-%H%M%S-%f}{path.suffix}"
+        )
+        try:
+            path.rename(archive)
+        except OSError:
+            return  # E.g. opened in a viewer on Windows, retry next time
+        # Don't leave the log missing until the next message, viewers may
+        # open it any time
+        try:
+            self.files[path] = open(path, "a", encoding="utf-8")
+            self.opened[path] = time.monotonic()
+        except OSError:
+            pass  # Opened again on the next message
+        # Compressing takes a while, don't hold back logging meanwhile
+        threading.Thread(
+            target=compress_log,
+            args=(archive, path, self.max_archives),
+            name="buttonbox_log_compress",
+            daemon=True,
+        ).start()
+
+
+def compress_log(archive: Path, path: Path, max_archives: int) -> None:
+    """
+    Gzip `archive` and delete all but the newest `max_archives` archives of
+    the log at `path`.
+    """
+    compressed = archive.with_name(archive.name + ".gz")
+    partial = archive.with_name(archive.name + ".gz.part")
+    try:
+        with open(archive, "rb") as src, gzip.open(partial, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        partial.replace(compressed)
+        archive.unlink()
+        archives = sorted(path.parent.glob(f"{path.stem}.*{path.suffix}.gz"))
+        for old in archives[:max(len(archives) - max_archives, 0)]:
+            old.unlink(missing_ok=True)
+    except OSError as e:
+        log(f"Failed to archive {archive} ({e})", "WARNING")
+
+
+LOG_WRITER = LogWriter()
+atexit.register(LOG_WRITER.flush)
+
+
+def format_log_message(msg: str, args: tuple[object, ...]) -> str:
+    """%-format `msg`, with bytes arguments decoded as UTF-8."""
+    try:
+        return msg % tuple(
+            arg.decode("utf-8", "replace") if isinstance(arg, bytes) else arg
+            for arg in args
+        )
+    except (TypeError, ValueError):
+        return f"{msg} {args!r}"
+
+
+def set_log_level(level: str) -> None:
+    global log_level
+    if level not in LOG_LEVELS:
+        log_level = LOG_LEVELS["INFO"]
+        log(f"Invalid log level '{level}', using INFO", "WARNING")
+        return
+    log_level = LOG_LEVELS[level]
+
+
+def log(msg: str, level: str = "INFO", *args: object) -> None:
+    """
+    Log `msg` unless `level` is below the configured level. Any `args` are
+    %-formatted into `msg` by the log writer, so suppressed messages aren't
+    formatted at all. They must not be changed after the call.
+    """
+    # Unknown levels are logged like INFO instead of failing
+    if LOG_LEVELS.get(level, LOG_LEVELS["INFO"]) < log_level:
+        return
+    LOG_WRITER.put(LOGGER_PATH, level, msg, args)
+    if level == "CRITICAL":
+        LOG_WRITER.flush()
 
 
 def log_mc(msg: str) -> None:
-    with open(MC_DEBUG_LOG_PATH, "a", encoding="utf-8") as fp:
-        fp.write(f"[{datetime.now().isoformat()}] {msg}\n")
+    LOG_WRITER.put(MC_DEBUG_LOG_PATH, None, msg)
 
 
 class LogStream:
@@ -182,3 +621,6 @@ class LogStream:
 
     def write(self, text: str) -> None:
         log(text, self.level)
+        # Used for tracebacks, which should make it to disk even if the
+        # client goes down right after
+        LOG_WRITER.flush()
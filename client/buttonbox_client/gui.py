@@ -14,9 +14,9 @@ from pynput.keyboard import Key
 from PyQt6.QtCore import QModelIndex, Qt, QTimer
 from PyQt6.QtGui import QCloseEvent, QKeySequence, QMouseEvent
 from PyQt6.QtWidgets import (QApplication, QComboBox, QDialog, QHBoxLayout,
-                             QKeySequenceEdit, QLabel, QLineEdit, QListWidget,
-                             QListWidgetItem, QMainWindow, QMessageBox,
-                             QWidget)
+                             QInputDialog, QKeySequenceEdit, QLabel, QLineEdit,
+                             QListWidget, QListWidgetItem, QMainWindow,
+                             QMessageBox, QWidget)
 from serial import SerialException
 from serial.tools.list_ports import comports
 
@@ -50,10 +50,12 @@ except ImportError:
     from ui.window_ui import Ui_MainWindow
 
 try:
-    from . import config, version
+    from . import config, history, protocol, version
     config.init_config()
 except ImportError:
     import config  # type: ignore[no-redef]
+    import history  # type: ignore[no-redef]
+    import protocol  # type: ignore[no-redef]
     import version  # type: ignore[no-redef]
     config.init_config()
 
@@ -81,13 +83,33 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
         self.last_rot_counterclockwise_time = 0.0
         self.rot_counterclockwise_count = 0
         self.last_rot_both_time = 0.0
+        # Kept up to date by the config, as they're needed on every event
+        self.rot_debounce_time = 0.0
+        self.rot_sensitivity = 1
+        self.auto_detect_profiles = True
+        config.observe_config_value(
+            "rotary_encoder_debounce_time",
+            partial(setattr, self, "rot_debounce_time"),
+        )
+        config.observe_config_value(
+            "rotary_encoder_sensitivity",
+            partial(setattr, self, "rot_sensitivity"),
+        )
+        config.observe_config_value(
+            "auto_detect_profiles",
+            partial(setattr, self, "auto_detect_profiles"),
+        )
+        # Last reported button states, to only dispatch changes
+        self.button_matrix_state = 0
+        self.button_single_state = 0
         self.main_widget_detected = False
         self.macros = config.get_macros()
+        model.compile_macros(self.macros)
         self.profiles = model.sort_dict(model.load_profiles())
         self.current_profile: Optional[model.Profile] = None
         self.test_mode = False
         self.test_profile = model.TestProfile()
-        self.games_instances = {}
+        self.games_instances: dict[type[model.Game], model.Game] = {}
         for game in model.GAME_LOOKUP.values():
             if game == model.TestGame:
                 self.games_instances[game] = game(self.conn, self)
@@ -154,6 +176,11 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
         self.detectProfileTimer.timeout.connect(self.detect_profiles)
         self.detectProfileTimer.start(1000)
 
+        # Picks up edits of the config file, for the observers
+        self.configTimer = QTimer(self)
+        self.configTimer.timeout.connect(config.check_config)
+        self.configTimer.start(1000)
+
         self.ledManagerTimer = QTimer(self)
         self.ledManagerTimer.timeout.connect(self.call_led_manager)
         self.ledManagerTimer.start(100)
@@ -162,7 +189,7 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
             QTimer.singleShot(500, self.hide)
 
     def detect_profiles(self) -> None:
-        if not config.get_config_value("auto_detect_profiles"):
+        if not self.auto_detect_profiles:
             return
         for profile in self.profiles.values():
             detect_method = profile.auto_activate_method()
@@ -213,10 +240,7 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
         led_manager(self.games_instances[game])
 
     def _rot_clockwise(self) -> None:
-        debounce_time: float = config.get_config_value(
-            "rotary_encoder_debounce_time"
-        )
-        if time.time() - debounce_time < self.last_rot_both_time:
+        if time.time() - self.rot_debounce_time < self.last_rot_both_time:
             return
 
         if time.time() - self.last_rot_clockwise_time > 1.0:
@@ -224,8 +248,7 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
             self.last_rot_clockwise_time = time.time()
         self.rot_clockwise_count += 1
 
-        sens: int = config.get_config_value("rotary_encoder_sensitivity")
-        if self.rot_clockwise_count >= sens:
+        if self.rot_clockwise_count >= self.rot_sensitivity:
             self.rot_clockwise_count = 0
             self.last_rot_clockwise_time = time.time()
 
@@ -239,10 +262,7 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
                 self.controller.tap(Key.media_volume_up)
 
     def _rot_counterclockwise(self) -> None:
-        debounce_time: float = config.get_config_value(
-            "rotary_encoder_debounce_time"
-        )
-        if time.time() - debounce_time < self.last_rot_both_time:
+        if time.time() - self.rot_debounce_time < self.last_rot_both_time:
             return
 
         if time.time() - self.last_rot_counterclockwise_time > 1.0:
@@ -250,8 +270,7 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
             self.last_rot_counterclockwise_time = time.time()
         self.rot_counterclockwise_count += 1
 
-        sens: int = config.get_config_value("rotary_encoder_sensitivity")
-        if self.rot_counterclockwise_count >= sens:
+        if self.rot_counterclockwise_count >= self.rot_sensitivity:
             self.rot_counterclockwise_count = 0
             self.last_rot_counterclockwise_time = time.time()
 
@@ -265,21 +284,29 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
                 self.controller.tap(Key.media_volume_down)
 
     def _button_single(self, state: int) -> None:
-        if not self.current_profile:
+        if state == self.button_single_state:
             return
-        model.exec_entry(
-            self.current_profile.button_single,
-            bool(state),
-            self.games_instances,
-        )
-
-    def _button_matrix(self, matrix: list[list[int]]) -> None:
+        self.button_single_state = state
         if not self.current_profile:
             return
-        for i, row in enumerate(matrix):
-            for j, state in enumerate(row):
-                entry = self.current_profile.get_button_matrix_entry_for(i, j)
-                model.exec_entry(entry, bool(state), self.games_instances)
+        handler = self.current_profile.dispatch_table(
+            self.games_instances
+        )[protocol.SINGLE_BIT]
+        if handler is not None:
+            handler(bool(state))
+
+    def _button_matrix(self, mask: int) -> None:
+        changed = mask ^ self.button_matrix_state
+        self.button_matrix_state = mask
+        if not changed or not self.current_profile:
+            return
+        table = self.current_profile.dispatch_table(self.games_instances)
+        while changed:
+            lowest = changed & -changed
+            changed ^= lowest
+            handler = table[lowest.bit_length() - 1]
+            if handler is not None:
+                handler(bool(mask & lowest))
 
     def _mc_debug(self, msg: str) -> None:
         config.log_mc(f"[DEBUG] {msg}")
@@ -387,6 +414,7 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
     def set_profile(self, text: str) -> None:
         if text == "test":
             self.current_profile = self.test_profile
+            self.current_profile.compile(self.games_instances)
             return
         if text.lower() == "none":
             self.current_profile = None
@@ -410,6 +438,7 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
             )
             return
         self.current_profile = profile
+        self.current_profile.compile(self.games_instances)
         if self.main_widget_detected:
             self.profileCombo.setCurrentText(profile.name)
 
@@ -429,7 +458,7 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
                     self.conn.ser.read_all()
                 except SerialException:
                     pass
-            self.conn.write_queue.clear()
+            self.conn.clear_write_queue()
             self.testModeFrame.setEnabled(False)
             self.current_profile = None
 
@@ -471,7 +500,8 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
 
     def dark_mode(self) -> None:
         dark = self.actionDark_Mode.isChecked()
-        config.set_config_value("dark", dark)
+        # The menu entry can be toggled quickly
+        config.set_config_value("dark", dark, debounce=True)
         self.apply_dark()
 
     def apply_dark(self) -> None:
@@ -510,6 +540,16 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
         if dialog.exec() == QDialog.DialogCode.Accepted:
             self.profiles = dialog.profiles
             model.save_profiles(self.profiles)
+            if (
+                not self.test_mode
+                and self.current_profile is not None
+                and self.current_profile not in self.profiles.values()
+            ):
+                # The active profile was edited or deleted, switch to the
+                # edited copy so the changes take effect
+                names = [profile.name for profile in self.profiles.values()]
+                name = self.current_profile.name
+                self.set_profile(name if name in names else "None")
 
     def serial_monitor(self) -> None:
         dialog = SerialMonitor(self, self.conn)
@@ -519,30 +559,29 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
         dialog = Settings(self)
         if dialog.exec() == QDialog.DialogCode.Accepted:
             selected_port = dialog.portBox.currentText()
-            config.set_config_value("default_port", selected_port)
             selected_baudrate = dialog.baudrateSpin.value()
-            config.set_config_value("baudrate", selected_baudrate)
             self.conn.port = selected_port
             self.conn.baudrate = selected_baudrate
-            rotary_sens = dialog.rotarySensSpin.value()
-            config.set_config_value("rotary_encoder_sensitivity", rotary_sens)
-            rotary_debounce = dialog.rotaryDebounceSpin.value()
-            config.set_config_value(
-                "rotary_encoder_debounce_time", rotary_debounce
-            )
-            auto_detect_profiles = dialog.autoDetectCheck.isChecked()
-            config.set_config_value(
-                "auto_detect_profiles", auto_detect_profiles
-            )
-            hide_to_tray = dialog.hideToTrayCheck.isChecked()
-            config.set_config_value(
-                "hide_to_tray", hide_to_tray
-            )
+            with config.config_transaction() as changes:
+                changes["default_port"] = selected_port
+                changes["baudrate"] = selected_baudrate
+                changes["rotary_encoder_sensitivity"] = (
+                    dialog.rotarySensSpin.value()
+                )
+                changes["rotary_encoder_debounce_time"] = (
+                    dialog.rotaryDebounceSpin.value()
+                )
+                changes["auto_detect_profiles"] = (
+                    dialog.autoDetectCheck.isChecked()
+                )
+                changes["hide_to_tray"] = dialog.hideToTrayCheck.isChecked()
+                changes["log_level"] = dialog.logLevelBox.currentText()
             self.conn.reconnect()
 
     def keyboard_shortcuts(self) -> None:
         dialog = KeyboardShortcuts(self, self.macros)
         if dialog.exec() == QDialog.DialogCode.Accepted:
+            shortcuts: dict[tuple[str, str], str] = {}
             for entry in dialog.items:
                 game = entry[0]
                 action = entry[1]
@@ -563,13 +602,15 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
                         "graphics (AltGr). Please do not use these characters."
                     )
                     continue
-                config.set_keyboard_shortcut(game, action, shortcut)
+                shortcuts[(game, action)] = shortcut
+            config.set_keyboard_shortcuts(shortcuts)
 
     def macro_editor(self) -> None:
         dialog = MacroEditor(self, deepcopy(self.macros))
         if dialog.exec() == QDialog.DialogCode.Accepted:
             self.macros = dialog.macros
             config.set_macros(self.macros)
+            model.compile_macros(self.macros)
 
     def manage_custom_actions(self) -> None:
         dialog = CustomActionsManager(self)
@@ -590,6 +631,10 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
             model.register_custom_shortcut_actions()
             model.populate_game_actions()
             self.games_instances[model.Custom].register_lambdas()  # type: ignore[attr-defined]  # noqa
+            # Compiled profiles still reference the old custom actions
+            for profile in self.profiles.values():
+                profile.invalidate()
+            self.test_profile.invalidate()
 
     def open_github(self) -> None:
         try:
@@ -608,6 +653,8 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
                 )
 
     def open_log(self) -> None:
+        # Show what's still queued for writing as well
+        config.LOG_WRITER.flush()
         try:
             webbrowser.WindowsDefault().open(str(config.LOGGER_PATH))  # type: ignore[attr-defined]  # noqa
         except Exception:
@@ -618,8 +665,20 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
                 getoutput(f"open {config.LOGGER_PATH}")
 
     def export_open_serial_history(self) -> None:
-        with open(config.SER_HISTORY_PATH, "w", encoding="utf-8") as fp:
-            fp.writelines(self.conn.full_history)
+        capture = self.conn.capture
+        if capture:
+            minutes, ok = QInputDialog.getInt(
+                self, "Export Serial History",
+                "Export the serial capture of the last minutes:", 10, 1,
+            )
+            if not ok:
+                return
+            end = capture.now()
+            lines = capture.export(end - minutes * 60_000_000_000, end)
+        else:
+            lines = [self.conn.history.read()[0]]
+        with open(config.SER_HISTORY_PATH, "wb") as fp:
+            fp.writelines(lines)
 
         try:
             webbrowser.WindowsDefault().open(str(config.SER_HISTORY_PATH))  # type: ignore[attr-defined]  # noqa
@@ -631,6 +690,8 @@ class Window(QMainWindow, Ui_MainWindow):  # type: ignore[misc]
                 getoutput(f"open {config.SER_HISTORY_PATH}")
 
     def mcdebug_log(self) -> None:
+        # Show what's still queued for writing as well
+        config.LOG_WRITER.flush()
         try:
             webbrowser.WindowsDefault().open(str(config.MC_DEBUG_LOG_PATH))  # type: ignore[attr-defined]  # noqa
         except Exception:
@@ -888,6 +949,7 @@ class ProfileEditor(QDialog, Ui_ProfileEditor):  # type: ignore[misc]
         self.profile.led_profile = new
 
     def single_changed(self) -> None:
+        self.profile.invalidate()
         if self.singleTypeCombo.currentText() == "Off":
             self.profile.button_single["type"] = None
             self.profile.button_single["value"] = None
@@ -999,7 +1061,9 @@ class SerialMonitor(QDialog, Ui_SerialMonitor):  # type: ignore[misc]
         self.timer = QTimer(self)
         self.timer.timeout.connect(self.refresh)
         self.timer.start(100)
-        self.from_index = 0
+        self.from_cursor = 0
+        # History cursor the shown text was read up to
+        self.shown_cursor = -1
 
     def connectSignalsSlots(self) -> None:
         self.enterBtn.clicked.connect(self.enter)
@@ -1010,10 +1074,16 @@ class SerialMonitor(QDialog, Ui_SerialMonitor):  # type: ignore[misc]
         self.monitorText.clear()
 
     def refresh(self) -> None:
-        history = self.conn.in_history.copy()
-        history.append("")
+        self.setWindowTitle(
+            f"Serial Monitor ({self.conn.write_queue.stats()})"
+        )
+        if self.conn.history.end == self.shown_cursor:
+            return
+        data, self.shown_cursor = self.conn.history.read(
+            self.from_cursor, history.IN
+        )
         # [:-1] to strip the last newline
-        new_text = "".join(history[self.from_index:])[:-1]
+        new_text = data.decode("utf-8", "replace")[:-1]
         if self.monitorText.toPlainText() != new_text:
             self.monitorText.setPlainText(new_text)
             self.monitorText.verticalScrollBar().setValue(
@@ -1023,11 +1093,12 @@ class SerialMonitor(QDialog, Ui_SerialMonitor):  # type: ignore[misc]
     def enter(self) -> None:
         cmd = self.cmdEdit.text()
         if cmd:
-            self.conn.write_queue.append(cmd)
+            self.conn.write(cmd, protocol.PRIORITY_RAW)
         self.cmdEdit.setText("")
 
     def clear(self) -> None:
-        self.from_index = len(self.conn.in_history)
+        self.from_cursor = self.conn.history.end
+        self.shown_cursor = -1
         self.refresh()
 
 
@@ -1065,6 +1136,15 @@ class Settings(QDialog, Ui_Settings):  # type: ignore[misc]
             config.get_config_value("hide_to_tray")
         )
 
+        self.logLevelBox.clear()
+        self.logLevelBox.addItems(
+            [level for level in config.LOG_LEVELS if level != "TRACE"]
+        )
+        level = config.get_config_value("log_level")
+        self.logLevelBox.setCurrentText(
+            level if level in config.LOG_LEVELS else "INFO"
+        )
+
 
 class KeyboardShortcuts(QDialog, Ui_KeyboardShortcuts):  # type: ignore[misc]
     def __init__(self, parent: QWidget, macros: list[config.MACRO]) -> None:
@@ -1292,9 +1372,15 @@ class MacroEditor(QDialog, Ui_MacroEditor):  # type: ignore[misc]
         elif what == 8:  # Right Mouse Button Down
             type = "right_mouse_button_down"
             value = None
-        else:  # Right Mouse Button Up
+        elif what == 9:  # Right Mouse Button Up
             type = "right_mouse_button_up"
             value = None
+        elif what == 10:  # Type Text
+            type = "type_text"
+            value = ""
+        else:  # Key Sequence
+            type = "key_sequence"
+            value = ""
         action: config.MACRO_ACTION = {
             "type": type,
             "value": value,
@@ -1383,17 +1469,44 @@ class MacroEditor(QDialog, Ui_MacroEditor):  # type: ignore[misc]
         if cur_action is None:
             return
 
-        mode: Literal["delay", "key"]
+        mode: Literal["delay", "key", "text", "sequence"]
         if cur_action["type"] == "delay":
             mode = "delay"
         elif cur_action["type"] in ("press_key", "release_key"):
             mode = "key"
+        elif cur_action["type"] == "type_text":
+            mode = "text"
+        elif cur_action["type"] == "key_sequence":
+            mode = "sequence"
         else:
             return
-        dialog = MacroActionEditor(self, mode, cur_action["value"])  # type: ignore[arg-type]  # noqa
+        interval = cur_action.get("interval")
+        if not isinstance(interval, int):
+            interval = config.get_config_value("macro_key_interval")
+        dialog = MacroActionEditor(
+            self, mode, cur_action["value"], interval  # type: ignore[arg-type]  # noqa
+        )
         if dialog.exec() == QDialog.DialogCode.Accepted:
             if mode == "delay":
                 cur_action["value"] = dialog.delaySpin.value()
+            elif mode == "text":
+                cur_action["value"] = dialog.textEdit.text()
+                cur_action["interval"] = dialog.delaySpin.value()
+            elif mode == "sequence":
+                sequence = dialog.keySequence.keySequence().toString()
+                try:
+                    sequence.encode("utf-8")
+                except UnicodeEncodeError:
+                    config.log("Invalid key sequence configured", "ERROR")
+                    show_error(
+                        self, "Invalid Character",
+                        "You entered an invalid character in the key sequence."
+                        " This commonly happens when using alternate graphics"
+                        " (AltGr). Please do not use these characters."
+                    )
+                    return
+                cur_action["value"] = sequence
+                cur_action["interval"] = dialog.delaySpin.value()
             else:
                 if dialog.modCombo.currentText() in model.MODS:
                     shortcut = dialog.modCombo.currentText()
@@ -1507,10 +1620,17 @@ class MacroEditor(QDialog, Ui_MacroEditor):  # type: ignore[misc]
 
     def _action_to_str(self, action: config.MACRO_ACTION) -> str:
         name = action["type"].title().replace("_", " ")  # type: ignore[union-attr]  # noqa
-        if action["type"] in ("press_key", "release_key", "delay"):
+        if action["type"] in (
+            "press_key", "release_key", "delay", "type_text", "key_sequence"
+        ):
             name += f": {action['value']}"
         if action["type"] == "delay":
             name += "ms"
+        elif (
+            action["type"] in ("type_text", "key_sequence")
+            and action.get("interval") is not None
+        ):
+            name += f" ({action['interval']}ms apart)"
         return name
 
 
@@ -1518,12 +1638,15 @@ class MacroActionEditor(QDialog, Ui_EditAction):  # type: ignore[misc]  # noqa
     def __init__(
         self,
         parent: QWidget,
-        type: Union[Literal["delay"], Literal["key"]],
+        type: Literal["delay", "key", "text", "sequence"],
         preset: Union[str, int],
+        interval: int = 0,
     ) -> None:
         super().__init__(parent)
         self.type = type
         self.preset = preset
+        # Milliseconds between keys in the "text" and "sequence" modes
+        self.interval = interval
         self.setupUi(self)
         self.connectSignalsSlots()
 
@@ -1536,6 +1659,8 @@ class MacroActionEditor(QDialog, Ui_EditAction):  # type: ignore[misc]  # noqa
             self.keyLabel.setMaximumHeight(0)
             self.modCombo.setMaximumHeight(0)
             self.keySequence.setMaximumHeight(0)
+            self.textLabel.setMaximumHeight(0)
+            self.textEdit.setMaximumHeight(0)
             if not isinstance(self.preset, int):
                 show_error(
                     self, "Invalid Preset",
@@ -1548,6 +1673,39 @@ class MacroActionEditor(QDialog, Ui_EditAction):  # type: ignore[misc]  # noqa
                 self.reject()
                 return
             self.delaySpin.setValue(self.preset)
+        elif self.type in ("text", "sequence"):
+            self.delayLabel.setText("Key Interval:")
+            self.delayLabel.setEnabled(True)
+            self.delaySpin.setEnabled(True)
+            self.msLabel.setEnabled(True)
+            self.delaySpin.setValue(self.interval)
+            self.modCombo.setMaximumHeight(0)
+            if not isinstance(self.preset, str):
+                show_error(
+                    self, "Invalid Preset",
+                    f"Invalid Preset {self.preset} for mode {self.type}",
+                )
+                config.log(
+                    f"Invalid Preset {self.preset} for mode {self.type}",
+                    "ERROR",
+                )
+                self.reject()
+                return
+            if self.type == "text":
+                self.textLabel.setEnabled(True)
+                self.textEdit.setEnabled(True)
+                self.textEdit.setText(self.preset)
+                self.keyLabel.setMaximumHeight(0)
+                self.keySequence.setMaximumHeight(0)
+            else:
+                self.keyLabel.setText("Key Sequence:")
+                self.keyLabel.setEnabled(True)
+                self.keySequence.setEnabled(True)
+                self.keySequence.setKeySequence(
+                    QKeySequence.fromString(self.preset)
+                )
+                self.textLabel.setMaximumHeight(0)
+                self.textEdit.setMaximumHeight(0)
         else:
             self.keyLabel.setEnabled(True)
             self.modCombo.setEnabled(True)
@@ -1555,6 +1713,8 @@ class MacroActionEditor(QDialog, Ui_EditAction):  # type: ignore[misc]  # noqa
             self.delayLabel.setMaximumHeight(0)
             self.delaySpin.setMaximumHeight(0)
             self.msLabel.setMaximumHeight(0)
+            self.textLabel.setMaximumHeight(0)
+            self.textEdit.setMaximumHeight(0)
             if not isinstance(self.preset, str):
                 show_error(
                     self, "Invalid Preset",
@@ -0,0 +1,114 @@
+import threading
+from array import array
+from typing import Iterable, Optional
+
+# Directions
+IN = 0
+OUT = 1
+# Prefixes in the combined history, double space for alignment with [OUT]
+PREFIXES = (b"[IN]  ", b"[OUT] ")
+
+# The offsets are unsigned 32 bit, leave room for lines not yet compacted
+MAX_ARENA = 2**30
+# Evicted lines are only removed from the arena once there are this many
+COMPACT_MIN = 1024
+
+
+class History:
+    """
+    Ring buffer of the lines sent to and received from the microcontroller.
+    Once `max_entries` lines or `max_bytes` bytes are exceeded the oldest
+    lines are dropped. A limit of 0 disables it.
+
+    Lines are stored back to back in a single bytearray, with the offset at
+    which each line ends and its direction kept in parallel arrays. Dropped
+    lines are skipped over and only cut off the arena once they make up half
+    of it, which keeps dropping lines O(1) on average.
+
+    Every line gets a sequence number (its cursor), so readers can ask for
+    the lines since the last one they have seen, see read().
+    """
+
+    def __init__(self, max_entries: int = 0, max_bytes: int = 0) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = min(max_bytes or MAX_ARENA, MAX_ARENA)
+        self.arena = bytearray()
+        self.ends = array("I")
+        self.directions = bytearray()
+        # Index of the oldest line still stored in ends and directions
+        self.first = 0
+        # Cursor of the oldest line still stored
+        self.start = 0
+        # Appended to by the serial thread, read by the GUI
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ends) - self.first
+
+    @property
+    def end(self) -> int:
+        """Cursor the next line will get."""
+        return self.start + len(self)
+
+    @property
+    def size(self) -> int:
+        """Bytes taken up by the stored lines."""
+        return len(self.arena) - self._offset(self.first)
+
+    def _offset(self, index: int) -> int:
+        return self.ends[index - 1] if index else 0
+
+    def append(self, direction: int, line: bytes) -> None:
+        """Store `line` (without its newline)."""
+        with self.lock:
+            self._append(direction, line)
+
+    def extend(self, direction: int, lines: Iterable[bytes]) -> None:
+        with self.lock:
+            for line in lines:
+                self._append(direction, line)
+
+    def _append(self, direction: int, line: bytes) -> None:
+        self.arena += line
+        self.ends.append(len(self.arena))
+        self.directions.append(direction)
+        while (
+            self.max_entries and len(self) > self.max_entries
+            or self.size > self.max_bytes
+        ):
+            self.first += 1
+            self.start += 1
+        if self.first >= COMPACT_MIN and self.first * 2 >= len(self.ends):
+            self._compact()
+
+    def _compact(self) -> None:
+        """Cut the dropped lines off the arrays."""
+        offset = self._offset(self.first)
+        del self.arena[:offset]
+        self.ends = array(
+            "I", (end - offset for end in self.ends[self.first:])
+        )
+        del self.directions[:self.first]
+        self.first = 0
+
+    def read(
+        self, cursor: int = 0, direction: Optional[int] = None
+    ) -> tuple[bytes, int]:
+        """
+        Lines from `cursor` on, or from the oldest line still stored if those
+        were already dropped, and the cursor to continue reading from. Every
+        line ends with a newline. Without a `direction`, lines of both
+        directions are returned, prefixed with [IN] or [OUT].
+        """
+        with self.lock:
+            data = bytearray()
+            for i in range(
+                self.first + max(cursor - self.start, 0), len(self.ends)
+            ):
+                if direction is None:
+                    data += PREFIXES[self.directions[i]]
+                elif self.directions[i] != direction:
+                    continue
+                data += self.arena[self._offset(i):self.ends[i]]
+                data += b"\n"
+            return bytes(data), self.end
@@ -1,13 +1,18 @@
+import heapq
 import json
+import os
+import signal
 import sys
 import time
+import traceback
+from collections import deque
 from contextlib import contextmanager
+from copy import deepcopy
 from functools import partial
-from itertools import chain
+from itertools import chain, count
 from pathlib import Path
-from random import randint
-from subprocess import getoutput
-from threading import Thread
+from subprocess import DEVNULL, PIPE, STDOUT, Popen
+from threading import Condition, Lock, Thread, Timer
 from typing import TYPE_CHECKING, Any, Callable, Generator, Optional, Union
 
 from pynput.keyboard import Controller as KController
@@ -74,9 +79,6 @@ KEY_LOOKUP = {
     "Up": Key.up,
 }
 
-
-STATE = {True: "HIGH", False: "LOW"}
-
 GAME_ACTION_ENTRY = dict[str, str]
 BUTTON_ENTRY = dict[
     str, Union[
@@ -93,14 +95,12 @@ PROFILE = dict[
         list[list[BUTTON_ENTRY]],
     ]
 ]
+# Handlers indexed by button bit (see protocol.button_bit()), None if unused
+DISPATCH_TABLE = list[Optional[Callable[[bool], None]]]
 
 
 SHORTCUT_ACTIONS: list[Callable[[Any, bool], None]] = []
 
-# A command should not be triggered again just because the button is held.
-# It should only be triggered again if the button was released in between.
-COMMANDS_TO_BE_RELEASED: list[str] = []
-
 
 def register_shortcut_action(
     func: Callable[[Any, bool], Any]
@@ -109,40 +109,217 @@ def register_shortcut_action(
     return func
 
 
-def exec_entry(
+# Number of finished commands kept with their output, see CommandRunner
+COMMAND_HISTORY = 16
+
+
+class CommandProcess:
+    """A command started by a button, with the tail of its output."""
+
+    def __init__(self, button: int, cmd: str, proc: "Popen[bytes]") -> None:
+        self.button = button
+        self.cmd = cmd
+        self.proc = proc
+        self.started = time.monotonic()
+        # Last bytes of stdout and stderr, see CommandRunner.output_bytes
+        self.output = bytearray()
+        self.timed_out = False
+        self.timer: Optional[Timer] = None
+
+    def kill(self) -> None:
+        """Kill the command and everything it started."""
+        self.timed_out = True
+        try:
+            if sys.platform == "win32":
+                # /T includes the processes started by the shell
+                Popen(
+                    ["taskkill", "/T", "/F", "/PID", str(self.proc.pid)],
+                    stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+                ).wait()
+                self.proc.kill()
+            else:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+        except (OSError, ProcessLookupError):
+            pass  # Exited in the meantime
+
+
+class CommandRunner:
+    """
+    Starts the commands of "command" buttons without waiting for them, so
+    slow or long running programs don't hold up the serial thread. Every
+    command gets a thread collecting its output and exit code.
+    """
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        # Running commands by button bit
+        self.running: dict[int, list[CommandProcess]] = {}
+        self.finished: deque[CommandProcess] = deque(maxlen=COMMAND_HISTORY)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return sum(map(len, self.running.values()))
+
+    def run(self, button: int, cmd: str) -> Optional[CommandProcess]:
+        """Start `cmd` for `button`, unless a limit is reached."""
+        max_running = config.get_config_value("command_max_running")
+        max_per_button = config.get_config_value("command_max_per_button")
+        with self.lock:
+            if max_running and sum(
+                map(len, self.running.values())
+            ) >= max_running:
+                config.log(
+                    "Not running command '%s', %d commands are running "
+                    "already", "WARNING", cmd, max_running,
+                )
+                return None
+            running = self.running.setdefault(button, [])
+            if max_per_button and len(running) >= max_per_button:
+                config.log(
+                    "Not running command '%s', still running for button %d",
+                    "WARNING", cmd, button,
+                )
+                return None
+            output_bytes = config.get_config_value("command_output_bytes")
+            config.log("Running command '%s'", "DEBUG", cmd)
+            try:
+                proc = Popen(
+                    cmd,
+                    shell=True,
+                    stdin=DEVNULL,
+                    stdout=PIPE if output_bytes else DEVNULL,
+                    stderr=STDOUT if output_bytes else DEVNULL,
+                    # Own process group, to kill what the shell started too
+                    start_new_session=sys.platform != "win32",
+                )
+            except OSError as e:
+                config.log(f"Failed to run command '{cmd}' ({e})", "ERROR")
+                return None
+            process = CommandProcess(button, cmd, proc)
+            running.append(process)
+        timeout = config.get_config_value("command_timeout")
+        if timeout:
+            process.timer = Timer(timeout, process.kill)
+            process.timer.daemon = True
+            process.timer.start()
+        Thread(
+            target=self._watch,
+            args=(process, output_bytes),
+            name="buttonbox_command",
+            daemon=True,
+        ).start()
+        return process
+
+    def _watch(self, process: CommandProcess, output_bytes: int) -> None:
+        stdout = process.proc.stdout
+        if stdout is not None:
+            while chunk := os.read(stdout.fileno(), 4096):
+                process.output += chunk
+                if len(process.output) > output_bytes:
+                    del process.output[:-output_bytes]
+            stdout.close()
+        code = process.proc.wait()
+        if process.timer is not None:
+            process.timer.cancel()
+        with self.lock:
+            self.running[process.button].remove(process)
+            self.finished.append(process)
+        duration = time.monotonic() - process.started
+        if process.timed_out:
+            config.log(
+                "Command '%s' killed after %.1fs, output: %s",
+                "WARNING", process.cmd, duration,
+                bytes(process.output).strip(),
+            )
+        elif code:
+            config.log(
+                "Command '%s' exited with %d after %.1fs, output: %s",
+                "WARNING", process.cmd, code, duration,
+                bytes(process.output).strip(),
+            )
+        else:
+            config.log(
+                "Command '%s' finished after %.1fs", "DEBUG", process.cmd,
+                duration,
+            )
+
+
+COMMAND_RUNNER = CommandRunner()
+
+
+def run_command(button: int, cmd: str, state: bool) -> None:
+    # Only run on press, holding the button doesn't produce more edges
+    if state:
+        COMMAND_RUNNER.run(button, cmd)
+
+
+def compile_entry(
     entry: BUTTON_ENTRY,
-    state: bool,
     games_to_instance: dict[type["Game"], "Game"],
-) -> None:
-    config.log(
-        f"Executing action of type '{entry['type']}' and value "
-        f"'{entry['value']}' (state = {state})",
-        "DEBUG"
-    )
+    button: int,
+) -> Optional[Callable[[bool], None]]:
+    """
+    Resolve the entry of the button with bit `button` into a handler for its
+    edges. The handler gets True when the button was pressed and False when
+    it was released.
+    """
     if entry["type"] is None:
-        return
+        return None
     elif entry["type"] == "command":
         cmd: str = entry["value"]  # type: ignore[assignment]
-        if state:
-            if cmd in COMMANDS_TO_BE_RELEASED:
-                return
-            getoutput(cmd, encoding="utf-8")
-            COMMANDS_TO_BE_RELEASED.append(cmd)
-        else:
-            try:
-                COMMANDS_TO_BE_RELEASED.remove(cmd)
-            except ValueError:
-                pass
+        return partial(run_command, button, cmd)
     elif entry["type"] == "game_action":
         game = entry["value"]["game"]  # type: ignore[index]
         action = entry["value"]["action"]  # type: ignore[index]
-        instance = games_to_instance[GAME_LOOKUP[game]]
-        getattr(instance, action)(state)
+        try:
+            instance = games_to_instance[GAME_LOOKUP[game]]
+            handler: Callable[[bool], None] = getattr(instance, action)
+        except (KeyError, AttributeError) as e:
+            config.log(
+                f"Can't resolve action '{action}' of game '{game}' ({e})",
+                "ERROR",
+            )
+            return None
+        return handler
+    config.log(f"Invalid button entry type '{entry['type']}'", "ERROR")
+    return None
 
 
 class Profile:
     def __init__(self, data: PROFILE) -> None:
         self.data = data
+        self._dispatch_table: Optional[DISPATCH_TABLE] = None
+
+    def __deepcopy__(self, memo: dict[int, Any]) -> "Profile":
+        # The dispatch table references live Game instances, don't copy it
+        return Profile(deepcopy(self.data, memo))
+
+    def compile(
+        self, games_to_instance: dict[type["Game"], "Game"]
+    ) -> DISPATCH_TABLE:
+        """
+        Build the dispatch table. Matrix buttons are stored row by row,
+        followed by the single button, matching protocol.button_bit().
+        """
+        entries = [entry for row in self.button_matrix for entry in row]
+        entries.append(self.button_single)
+        table = [
+            compile_entry(entry, games_to_instance, bit)
+            for bit, entry in enumerate(entries)
+        ]
+        self._dispatch_table = table
+        return table
+
+    def dispatch_table(
+        self, games_to_instance: dict[type["Game"], "Game"]
+    ) -> DISPATCH_TABLE:
+        if self._dispatch_table is None:
+            return self.compile(games_to_instance)
+        return self._dispatch_table
+
+    def invalidate(self) -> None:
+        """Drop the dispatch table, it's rebuilt on the next use."""
+        self._dispatch_table = None
 
     @classmethod
     def empty(cls) -> "Profile":
@@ -182,6 +359,7 @@ class Profile:
     @button_single.setter
     def button_single(self, val: BUTTON_ENTRY) -> None:
         self.data["button_single"] = val
+        self.invalidate()
 
     @property
     def button_matrix(self) -> list[list[BUTTON_ENTRY]]:
@@ -190,6 +368,7 @@ class Profile:
     @button_matrix.setter
     def button_matrix(self, val: list[list[BUTTON_ENTRY]]) -> None:
         self.data["button_matrix"] = val
+        self.invalidate()
 
     def get_button_matrix_entry_for(self, row: int, col: int) -> BUTTON_ENTRY:
         return self.button_matrix[row][col]
@@ -201,6 +380,7 @@ class Profile:
         entry: BUTTON_ENTRY,
     ) -> None:
         self.button_matrix[row][col] = entry
+        self.invalidate()
 
     def led_manager_method(self) -> Optional[Callable[["Game"], None]]:
         if not self.led_profile:
@@ -217,7 +397,7 @@ class Profile:
 
 class TestProfile(Profile):
     def __init__(self) -> None:
-        self.data = Profile.empty().data
+        super().__init__(Profile.empty().data)
         self.led_profile = "test"
         self.button_single["type"] = "game_action"
         self.button_single["value"] = {
@@ -271,12 +451,10 @@ class Controller:
     ) -> None:
         if key:
             self.kc.press(key)
-            config.log(
-                f"Pressed key {key.char if isinstance(key, KeyCode) else key}"
-            )
+            config.log("Pressed key %s", "DEBUG", key)
         if but:
             self.mc.press(but)
-            config.log(f"Pressed button {but.name}")
+            config.log("Pressed button %s", "DEBUG", but.name)
 
     def release(
         self,
@@ -285,12 +463,10 @@ class Controller:
     ) -> None:
         if key:
             self.kc.release(key)
-            config.log(
-                f"Released key {key.char if isinstance(key, KeyCode) else key}"
-            )
+            config.log("Released key %s", "DEBUG", key)
         if but:
             self.mc.release(but)
-            config.log(f"Released button {but.name}")
+            config.log("Released button %s", "DEBUG", but.name)
 
     def tap(
         self,
@@ -383,28 +559,346 @@ def start_controller() -> Controller:
     return controller
 
 
-class MacroThread(Thread):
+# Operations of a compiled macro, see compile_macro()
+OP_PRESS_KEY = 0
+OP_RELEASE_KEY = 1
+OP_PRESS_BUTTON = 2
+OP_RELEASE_BUTTON = 3
+OP_DELAY = 4  # Argument in nanoseconds
+MACRO_OP = tuple[int, Any]
+
+# Waits shorter than this many nanoseconds are spun instead of slept, as
+# sleeping can overshoot by about as much
+MACRO_SPIN_NS = 1_000_000
+# Number of timing samples kept per macro
+MACRO_JITTER_SAMPLES = 1000
+
+MOUSE_BUTTON_OPS: dict[str, MACRO_OP] = {
+    "left_mouse_button_down": (OP_PRESS_BUTTON, Button.left),
+    "left_mouse_button_up": (OP_RELEASE_BUTTON, Button.left),
+    "middle_mouse_button_down": (OP_PRESS_BUTTON, Button.middle),
+    "middle_mouse_button_up": (OP_RELEASE_BUTTON, Button.middle),
+    "right_mouse_button_down": (OP_PRESS_BUTTON, Button.right),
+    "right_mouse_button_up": (OP_RELEASE_BUTTON, Button.right),
+}
+
+# Characters of a type_text action that KeyCode.from_char() can't type
+TEXT_KEYS = {
+    "\n": Key.enter,
+    "\t": Key.tab,
+}
+
+
+class CompiledMacro:
+    """A macro with its actions translated to a flat list of operations."""
+
+    def __init__(
+        self, name: str, mode: Union[str, int], ops: list[MACRO_OP]
+    ) -> None:
+        self.name = name
+        self.mode = mode
+        self.ops = ops
+
+
+# Compiled macros by name, see compile_macros()
+MACROS: dict[str, CompiledMacro] = {}
+
+
+def compile_macro(macro: config.MACRO) -> CompiledMacro:
+    """
+    Resolve the keys, mouse buttons and delays of all actions of `macro`, so
+    running it doesn't involve any parsing. Invalid actions are skipped.
+    """
+    ops: list[MACRO_OP] = []
+    actions: list[config.MACRO_ACTION] = macro["actions"]  # type: ignore[assignment]  # noqa
+    for action in actions:
+        type = action["type"]
+        value = action["value"]
+        if type in ("press_key", "release_key"):
+            if not isinstance(value, str):
+                config.log(f"Invalid value for type {type}: {value}", "ERROR")
+                continue
+            op = OP_PRESS_KEY if type == "press_key" else OP_RELEASE_KEY
+            for mods, key_code in Game._parse_shortcut(value):
+                for key in (*mods, key_code):
+                    if key is not None:
+                        ops.append((op, key))
+        elif type == "delay":
+            if not isinstance(value, int):
+                config.log(f"Invalid value for type {type}: {value}", "ERROR")
+                continue
+            ops.append((OP_DELAY, value * 1_000_000))
+        elif type in ("type_text", "key_sequence"):
+            if not isinstance(value, str):
+                config.log(f"Invalid value for type {type}: {value}", "ERROR")
+                continue
+            interval = action.get("interval")
+            if not isinstance(interval, int):
+                interval = config.get_config_value("macro_key_interval")
+            if type == "type_text":
+                ops.extend(_compile_text(value, interval * 1_000_000))
+            else:
+                ops.extend(_compile_sequence(value, interval * 1_000_000))
+        elif type in MOUSE_BUTTON_OPS:
+            ops.append(MOUSE_BUTTON_OPS[type])
+        else:
+            config.log(f"Invalid macro action type '{type}'", "ERROR")
+    return CompiledMacro(
+        macro["name"], macro["mode"], ops  # type: ignore[arg-type]
+    )
+
+
+def _compile_text(text: str, interval: int) -> list[MACRO_OP]:
+    """Press and release a key for every character, `interval` ns apart."""
+    ops: list[MACRO_OP] = []
+    for char in text:
+        key: Union[Key, KeyCode]
+        if char in TEXT_KEYS:
+            key = TEXT_KEYS[char]
+        else:
+            key = KeyCode.from_char(char)
+        if ops and interval:
+            ops.append((OP_DELAY, interval))
+        ops.append((OP_PRESS_KEY, key))
+        ops.append((OP_RELEASE_KEY, key))
+    return ops
+
+
+def _compile_sequence(sequence: str, interval: int) -> list[MACRO_OP]:
+    """
+    Press every combination of a Qt KeySequence, e.g. "Ctrl+C, Ctrl+V", and
+    release it again, last key first, with combinations `interval` ns apart.
+    """
+    ops: list[MACRO_OP] = []
+    for mods, key_code in Game._parse_shortcut(sequence):
+        keys = [*mods, key_code] if key_code is not None else mods
+        if not keys:
+            continue
+        if ops and interval:
+            ops.append((OP_DELAY, interval))
+        ops.extend((OP_PRESS_KEY, key) for key in keys)
+        ops.extend((OP_RELEASE_KEY, key) for key in reversed(keys))
+    return ops
+
+
+def compile_macros(macros: list[config.MACRO]) -> None:
+    """Replace the compiled macros, e.g. after they have been edited."""
+    global MACROS
+    # Swapped in at once, the serial thread may be looking up a macro
+    MACROS = {
+        macro["name"]: compile_macro(macro)  # type: ignore[misc]
+        for macro in macros
+    }
+
+
+class MacroRun:
+    """
+    A macro being run by the MacroScheduler. Its operations are run until a
+    delay, the scheduler then picks it up again once the delay is over.
+    """
+
     def __init__(
         self,
-        should_stop_list: set["MacroThread"],
-        target: Optional[Callable[..., None]],
-        *args: Any,
-        **kwargs: Any,
-    ):
-        self.should_stop_list = should_stop_list
-        super().__init__(
-            group=None,
-            target=target,
-            name=f"buttonbox-macro-thread-{randint(1000000, 9999999)}",
-            args=args,
-            kwargs=kwargs,
-            daemon=True,
+        macro: CompiledMacro,
+        controller: Controller,
+        on_finish: Callable[["MacroRun"], None],
+    ) -> None:
+        self.macro = macro
+        self.controller = controller
+        self.on_finish = on_finish
+        # Index of the next operation
+        self.pc = 0
+        # When the current delay ends, counted from the start of the macro
+        # so lateness doesn't add up over repeats
+        self.deadline = 0
+        # Passes left in the "Run N Times" mode
+        self.passes_left = macro.mode if isinstance(macro.mode, int) else 0
+        # time.monotonic_ns() when the macro was asked to stop
+        self.stop_requested_at: Optional[int] = None
+        self.finished = False
+        # Sequence number of the run's entry in the scheduler's heap, older
+        # entries are stale
+        self.entry = 0
+        # Pressed keys and mouse buttons, with the operation releasing them
+        self.held: dict[Any, int] = {}
+
+    def step(self) -> Optional[int]:
+        """
+        Run operations up to the next delay. Returns the delay in
+        nanoseconds, or None once the macro is done.
+        """
+        ops = self.macro.ops
+        if isinstance(self.macro.mode, int) and self.passes_left <= 0:
+            return None  # "Run 0 Times"
+        while True:
+            if self.stop_requested_at is not None:
+                self.release_held()
+                return None
+            if self.pc == len(ops):
+                self.pc = 0
+                if isinstance(self.macro.mode, int):
+                    self.passes_left -= 1
+                    if self.passes_left <= 0:
+                        return None
+                # Let other macros run between passes
+                return 0
+            op, arg = ops[self.pc]
+            self.pc += 1
+            if op == OP_DELAY:
+                return arg  # type: ignore[no-any-return]
+            elif op == OP_PRESS_KEY:
+                self.controller.press(arg)
+                self.held[arg] = OP_RELEASE_KEY
+            elif op == OP_RELEASE_KEY:
+                self.controller.release(arg)
+                self.held.pop(arg, None)
+            elif op == OP_PRESS_BUTTON:
+                self.controller.press(but=arg)
+                self.held[arg] = OP_RELEASE_BUTTON
+            else:
+                self.controller.release(but=arg)
+                self.held.pop(arg, None)
+
+    def release_held(self) -> None:
+        """Release everything the macro pressed, last pressed first."""
+        for thing, op in reversed(self.held.items()):
+            if op == OP_RELEASE_KEY:
+                self.controller.release(thing)
+            else:
+                self.controller.release(but=thing)
+        self.held.clear()
+
+
+class MacroScheduler:
+    """
+    Runs all macros on a single thread, ordered by the time their current
+    delay ends. Stopping a macro interrupts its delay.
+    """
+
+    def __init__(self) -> None:
+        # Entries are (deadline, sequence number, run), the sequence number
+        # keeps runs with the same deadline in order
+        self.heap: list[tuple[int, int, MacroRun]] = []
+        self.counter = count()
+        self.condition = Condition()
+        self.thread: Optional[Thread] = None
+        # Stops taking longer than this many nanoseconds are logged
+        self.stop_latency_warning = 1_000_000
+        # Nanoseconds from stop request to the macro having stopped
+        self.stop_latencies: deque[int] = deque(maxlen=1000)
+        # Nanoseconds each macro's operations ran later than planned
+        self.jitter: dict[str, deque[int]] = {}
+
+    def _set_stop_latency_warning(self, ms: float) -> None:
+        self.stop_latency_warning = int(ms * 1_000_000)
+
+    def start(self, run: MacroRun) -> None:
+        with self.condition:
+            if self.thread is None:
+                config.observe_config_value(
+                    "macro_stop_latency", self._set_stop_latency_warning
+                )
+                self.thread = Thread(
+                    target=self._run, name="buttonbox_macros", daemon=True
+                )
+                self.thread.start()
+            run.deadline = time.monotonic_ns()
+            self._schedule(run, run.deadline)
+
+    def stop(self, run: MacroRun) -> None:
+        """Stop `run` right away, releasing everything it holds."""
+        with self.condition:
+            if run.finished or run.stop_requested_at is not None:
+                return
+            run.stop_requested_at = time.monotonic_ns()
+            # Replaces the entry of its current delay
+            self._schedule(run, run.stop_requested_at)
+
+    def _schedule(self, run: MacroRun, deadline: int) -> None:
+        run.entry = next(self.counter)
+        heapq.heappush(self.heap, (deadline, run.entry, run))
+        self.condition.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                while not self.heap:
+                    self.condition.wait()
+                deadline, entry, run = self.heap[0]
+                if entry != run.entry or run.finished:
+                    heapq.heappop(self.heap)
+                    continue
+                wait = deadline - time.monotonic_ns()
+                if wait > MACRO_SPIN_NS:
+                    # Woken up early when a macro is started or stopped, as
+                    # that pushes an entry and notifies under the same lock
+                    self.condition.wait(
+                        (wait - MACRO_SPIN_NS) / 1_000_000_000
+                    )
+                    continue
+                if wait <= 0:
+                    heapq.heappop(self.heap)
+            if wait > 0:
+                # Spin the rest, without the lock so macros can still be
+                # started and stopped, and yielding to other threads
+                while time.monotonic_ns() < deadline:
+                    time.sleep(0)
+                continue
+            if run.stop_requested_at is None:
+                self.jitter.setdefault(
+                    run.macro.name, deque(maxlen=MACRO_JITTER_SAMPLES)
+                ).append(-wait)
+            try:
+                delay = run.step()
+            except Exception:
+                traceback.print_exc(file=config.LogStream("TRACE"))
+                delay = None
+            if delay is not None:
+                with self.condition:
+                    if entry == run.entry:
+                        # Not before now, so a macro yielding between passes
+                        # or running behind lets other due macros go first
+                        run.deadline = max(
+                            run.deadline + delay, time.monotonic_ns()
+                        )
+                        self._schedule(run, run.deadline)
+                continue
+            run.finished = True
+            if run.stop_requested_at is not None:
+                latency = time.monotonic_ns() - run.stop_requested_at
+                self.stop_latencies.append(latency)
+                config.log(
+                    "Macro %s stopped %d us after the stop request",
+                    "WARNING" if latency > self.stop_latency_warning
+                    else "DEBUG",
+                    run.macro.name, latency // 1000,
+                )
+            config.log(
+                "Macro %s finished, timing jitter in us (p50, p90, p99, "
+                "max): %s", "DEBUG", run.macro.name,
+                self.jitter_percentiles(run.macro.name),
+            )
+            run.on_finish(run)
+
+    def jitter_percentiles(
+        self, name: str
+    ) -> Optional[tuple[int, int, int, int]]:
+        """
+        How late the operations of macro `name` ran, in microseconds, as
+        50th, 90th and 99th percentile and maximum. None without samples.
+        """
+        samples = sorted(self.jitter.get(name, ()))
+        if not samples:
+            return None
+        return (
+            samples[len(samples) * 50 // 100] // 1000,
+            samples[len(samples) * 90 // 100] // 1000,
+            samples[len(samples) * 99 // 100] // 1000,
+            samples[-1] // 1000,
         )
-        self._stop_triggered = False
 
-    def trigger_stop(self) -> None:
-        self._stop_triggered = True
-        self.should_stop_list.add(self)
+
+MACRO_SCHEDULER = MacroScheduler()
 
 
 class Game:
@@ -415,9 +909,8 @@ class Game:
     def __init__(self, conn: "Connection", controller: Controller) -> None:
         self.conn = conn
         self.controller = controller
-        self._macros_threads: dict[str, MacroThread] = {}
-        self._macro_threads_that_should_stop: set[MacroThread] = set()
-        self._macro_threads_to_be_released: set[MacroThread] = set()
+        # Running macros by name
+        self._macro_runs: dict[str, MacroRun] = {}
 
     @staticmethod
     def actions() -> list[Callable[[Any, bool], None]]:
@@ -440,17 +933,27 @@ class Game:
         """
         return None
 
+    def _set_leds(
+        self,
+        left: Optional[bool] = None,
+        middle: Optional[bool] = None,
+        right: Optional[bool] = None,
+        extra: Optional[bool] = None,
+    ) -> None:
+        """Set several LEDs with one command, None keeps an LED as it is."""
+        self.conn.set_leds((left, middle, right, extra))
+
     def _led_left(self, state: bool) -> None:
-        self.conn.write(f"LED {STATE[state]} LEFT")
+        self._set_leds(left=state)
 
     def _led_middle(self, state: bool) -> None:
-        self.conn.write(f"LED {STATE[state]} MIDDLE")
+        self._set_leds(middle=state)
 
     def _led_right(self, state: bool) -> None:
-        self.conn.write(f"LED {STATE[state]} RIGHT")
+        self._set_leds(right=state)
 
     def _led_extra(self, state: bool) -> None:
-        self.conn.write(f"LED {STATE[state]} EXTRA")
+        self._set_leds(extra=state)
 
     @staticmethod
     def _parse_shortcut(
@@ -478,15 +981,12 @@ class Game:
                     config.log(
                         f"Tried to parse invalid key: {key} ({e})", "WARNING"
                     )
+                    key_code = None
             cuts.append((trans_mods, key_code))
         return cuts
 
     def _issue_macro(self, state: bool, macro_name: str) -> None:
-        macros = config.get_macros()
-        macro: Optional[config.MACRO] = None
-        for mac in macros:
-            if mac["name"] == macro_name:
-                macro = mac
+        macro = MACROS.get(macro_name)
         if macro is None:
             config.log(
                 f"_issue_macro called with invalid macro ({macro_name})",
@@ -494,101 +994,21 @@ class Game:
             )
             return
 
-        mode: Union[str, int] = macro["mode"]  # type: ignore[assignment]
-        name: str = macro["name"]  # type: ignore[assignment]
-        actions: list[config.MACRO_ACTION] = macro["actions"]  # type: ignore[assignment]  # noqa
-
+        run = self._macro_runs.get(macro.name)
         if state:
-            if name in self._macros_threads:
-                if mode != "until_pressed_again":
-                    return
-                thread = self._macros_threads[name]
-                if thread in self._macro_threads_to_be_released:
-                    self._macro_threads_to_be_released.remove(thread)
-                else:
-                    self._macros_threads[name].trigger_stop()
-            else:
-                thread = MacroThread(
-                    self._macro_threads_that_should_stop,
-                    self._exec_macro,
-                    m_name=name,
-                    m_mode=mode,
-                    m_actions=actions,
-                )
-                self._macros_threads[name] = thread
-                if mode == "until_pressed_again":
-                    self._macro_threads_to_be_released.add(thread)
-                thread.start()
-        else:
-            if name in self._macros_threads:
-                if mode != "until_released":
-                    return
-                self._macros_threads[name].trigger_stop()
-
-    def _exec_macro(
-        self,
-        m_name: str,
-        m_mode: str,
-        m_actions: list[config.MACRO_ACTION],
-    ) -> None:
-        def run() -> None:
-            for action in m_actions:
-                print(action)
-                type = action["type"]
-                value = action["value"]
-                if type in ("press_key", "release_key"):
-                    if not isinstance(value, str):
-                        config.log(
-                            f"Invalid value for type {type}: {value}", "ERROR"
-                        )
-                        return
-                    shortcuts = self._parse_shortcut(value)
-                    for combo in shortcuts:
-                        mods, key_code = combo
-                        all_keys: list[Union[Key, Optional[KeyCode]]] = [
-                            *mods, key_code
-                        ]
-                        for key in all_keys:
-                            if key is None:
-                                continue
-                            if type == "press_key":
-                                self.controller.press(key)
-                            else:
-                                self.controller.release(key)
-                elif type == "delay":
-                    if not isinstance(value, int):
-                        config.log(
-                            f"Invalid value for type {type}: {value}", "ERROR"
-                        )
-                        return
-                    time.sleep(value / 1000)
-                elif type == "left_mouse_button_down":
-                    self.controller.press(but=Button.left)
-                elif type == "left_mouse_button_up":
-                    self.controller.press(but=Button.left)
-                elif type == "middle_mouse_button_down":
-                    self.controller.press(but=Button.middle)
-                elif type == "middle_mouse_button_up":
-                    self.controller.press(but=Button.middle)
-                elif type == "right_mouse_button_down":
-                    self.controller.press(but=Button.right)
-                elif type == "right_mouse_button_up":
-                    self.controller.press(but=Button.right)
-                else:
-                    config.log(f"Invalid macro action type '{type}'")
-
-        if isinstance(m_mode, int):
-            for _ in range(m_mode):
-                run()
-
-        else:
-            while True:
-                run()
-                thread = self._macros_threads[m_name]
-                if thread in self._macro_threads_that_should_stop:
-                    break
-
-        del self._macros_threads[m_name]
+            if run is None:
+                run = MacroRun(macro, self.controller, self._macro_finished)
+                self._macro_runs[macro.name] = run
+                MACRO_SCHEDULER.start(run)
+            elif macro.mode == "until_pressed_again":
+                MACRO_SCHEDULER.stop(run)
+        elif run is not None and macro.mode == "until_released":
+            MACRO_SCHEDULER.stop(run)
+
+    def _macro_finished(self, run: MacroRun) -> None:
+        # Called from the scheduler thread
+        if self._macro_runs.get(run.macro.name) is run:
+            del self._macro_runs[run.macro.name]
 
     def _issue_shortcut(self, state: bool, shortcut: str) -> None:
         if shortcut.startswith("macro:"):
@@ -624,10 +1044,7 @@ class Default(Game):
     def led_manager(self) -> None:
         if time.time() - self.led_man_cooldown >= self.led_man_last:
             config.log("LED_MANAGER Default lighting up", "DEBUG")
-            self._led_left(True)
-            self._led_middle(True)
-            self._led_right(True)
-            self._led_extra(True)
+            self._set_leds(True, True, True, True)
             self.led_man_last = time.time()
 
 
@@ -693,14 +1110,15 @@ class TestGame(Game):
     def led_manager(self) -> None:
         states = (self.win.td0.isChecked(), self.win.td1.isChecked(),
                   self.win.td2.isChecked(), self.win.td3.isChecked(),)
-        str_states = map(str, map(int, states))
         config.log(
-            f"LED_MANAGER TestGame updating ({':'.join(str_states)})", "DEBUG"
+            "LED_MANAGER TestGame updating (%d:%d:%d:%d)", "DEBUG", *states
+        )
+        self._set_leds(
+            left=self.win.td1.isChecked(),
+            middle=self.win.td2.isChecked(),
+            right=self.win.td3.isChecked(),
+            extra=self.win.td0.isChecked(),
         )
-        self._led_extra(self.win.td0.isChecked())
-        self._led_left(self.win.td1.isChecked())
-        self._led_middle(self.win.td2.isChecked())
-        self._led_right(self.win.td3.isChecked())
 
 
 CUSTOM_ACTIONS: dict[str, str] = {}
@@ -729,27 +1147,22 @@ class Custom(Game):
 
     @staticmethod
     def actions() -> list[Callable[[Any, bool], None]]:
-        def create_lambda(
-            name: str, shortcut: str
-        ) -> Callable[[Any, bool], None]:
+        def create_lambda(name: str) -> Callable[[Any, bool], None]:
             # Need to create a lambda using an inner function to prevent
             # modifying the name in the outer scope. This would make all
             # lambdas have the last name as name, instead of their respective
             # names.
-            lamb = lambda self, state: self._issue_shortcut(state, shortcut)  # noqa
+            lamb = lambda self, state: self._issue_custom_shortcut(state, name)  # noqa
             lamb.__name__ = name
             return lamb
 
-        acts: list[Callable[[Any, bool], None]] = []
-        for name in CUSTOM_ACTIONS:
-            shortcut = config.get_keyboard_shortcut("custom", name)
-            if not shortcut:
-                lamb = lambda self, state: None  # noqa
-                lamb.__name__ = name
-            else:
-                lamb = create_lambda(name, shortcut)
-            acts.append(lamb)
-        return acts
+        return [create_lambda(name) for name in CUSTOM_ACTIONS]
+
+    def _issue_custom_shortcut(self, state: bool, name: str) -> None:
+        # Looked up on every use, so changed shortcuts apply right away
+        shortcut = config.get_keyboard_shortcut("custom", name)
+        if shortcut:
+            self._issue_shortcut(state, shortcut)
 
     @staticmethod
     def name_for_action(action: Callable[[Any, bool], None]) -> Optional[str]:
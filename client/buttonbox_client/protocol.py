@@ -0,0 +1,344 @@
+"""
+Framing for the serial protocol spoken with the microcontroller.
+
+Besides the line based text protocol there is a compact binary protocol,
+negotiated with ``PROTOCOL BINARY`` after the HANDSHAKE. Binary frames start
+with an opcode byte >= 0x80 followed by a fixed size payload, so they can be
+told apart from text lines (which are plain ASCII) in the same stream. Debug
+and error messages are still sent as text lines.
+
+After ``REPORT CHANGES <ms>`` the microcontroller only reports buttons that
+changed (``STATUS BUTTON CHANGE <bit> <state>`` or OP_BUTTON_CHANGE), plus a
+full keyframe every <ms> milliseconds.
+"""
+
+import re
+import threading
+from collections import deque
+from typing import Optional
+
+# Microcontroller -> client
+OP_BUTTONS = 0x80  # 3 byte little endian bitmask, see button_bit()
+OP_ROTARY_CLOCKWISE = 0x81
+OP_ROTARY_COUNTERCLOCKWISE = 0x82
+OP_BUTTON_CHANGE = 0x83  # 1 byte: button bit in bits 0-4, state in bit 7
+
+# Client -> microcontroller
+OP_LED = 0x90  # 1 byte: LED index in bits 0-1, state in bit 7
+OP_LED_SET = 0x91  # 1 byte: state of every LED, bit = LED index
+
+# Total frame size including the opcode
+FRAME_SIZES = {
+    OP_BUTTONS: 4,
+    OP_ROTARY_CLOCKWISE: 1,
+    OP_ROTARY_COUNTERCLOCKWISE: 1,
+    OP_BUTTON_CHANGE: 2,
+}
+OPCODE_NAMES = {
+    OP_BUTTONS: b"BUTTONS",
+    OP_ROTARY_CLOCKWISE: b"ROTARY CLOCKWISE",
+    OP_ROTARY_COUNTERCLOCKWISE: b"ROTARY COUNTERCLOCKWISE",
+    OP_BUTTON_CHANGE: b"BUTTON CHANGE",
+    OP_LED: b"LED",
+    OP_LED_SET: b"LED SET",
+}
+
+# Text lines never contain other control bytes. Neither they nor the buffer
+# get longer than MAX_LINE_LENGTH, what does is line noise or the binary
+# payload of a frame whose opcode was lost, see LineFramer.
+INVALID_TEXT = re.compile(rb"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+MAX_LINE_LENGTH = 256
+KNOWN_OPCODES = re.compile(
+    b"[" + b"".join(re.escape(bytes((op,))) for op in FRAME_SIZES) + b"]"
+)
+
+MATRIX_ROWS = 6
+MATRIX_COLS = 3
+SINGLE_BIT = MATRIX_ROWS * MATRIX_COLS
+MATRIX_MASK = (1 << SINGLE_BIT) - 1
+
+LED_INDICES = {"LEFT": 0, "MIDDLE": 1, "RIGHT": 2, "EXTRA": 3}
+LED_STATES = {"LOW": 0, "HIGH": 1}
+# Replies of firmware without LED SET, in text and binary mode
+LED_SET_REJECTED = (
+    b"ERROR Invalid LED task 'LED SET ",
+    b"ERROR Invalid binary task 0x%x" % OP_LED_SET,
+)
+
+# Priority classes of outbound commands, most important first
+PRIORITY_CONTROL = 0  # Handshake and protocol negotiation
+PRIORITY_RAW = 1  # Typed into the serial monitor
+PRIORITY_LED = 2
+PRIORITY_DISPLAY = 3
+PRIORITY_NAMES = ("control", "raw", "led", "display")
+
+# What to do when the queue is full and a command of the same priority as
+# the least important queued one comes in
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+
+
+def button_bit(row: int, col: int) -> int:
+    """Bit of a matrix button in an OP_BUTTONS bitmask."""
+    return row * MATRIX_COLS + col
+
+
+def parse_text_matrix(status: bytes) -> int:
+    """Bitmask of a text report like b"0:1:0;0:0:0;...;"."""
+    digits = status.replace(b":", b"").replace(b";", b"")
+    # Reversed, so the first button ends up in the lowest bit
+    return int(digits[::-1], 2)
+
+
+def encode_command(cmd: str, binary: bool) -> bytes:
+    """
+    Encode a text command for the wire. With the binary protocol, commands
+    that have an opcode are translated, everything else stays a text line.
+    """
+    if binary and cmd.startswith("LED "):
+        parts = cmd.split()
+        if (
+            len(parts) == 3
+            and parts[1] == "SET"
+            and len(parts[2]) == len(LED_INDICES)
+        ):
+            mask = 0
+            for i, state in enumerate(parts[2]):
+                if state == "1":
+                    mask |= 1 << i
+            return bytes((OP_LED_SET, mask))
+        if (
+            len(parts) == 3
+            and parts[1] in LED_STATES
+            and parts[2] in LED_INDICES
+        ):
+            return bytes((
+                OP_LED,
+                LED_INDICES[parts[2]] | LED_STATES[parts[1]] << 7,
+            ))
+    return cmd.encode("utf-8") + b"\n"
+
+
+def command_priority(cmd: str) -> int:
+    """Priority class of a command, see PRIORITY_NAMES."""
+    if cmd.startswith(("HANDSHAKE", "PROTOCOL ", "REPORT ")):
+        return PRIORITY_CONTROL
+    if cmd.startswith("LED "):
+        return PRIORITY_LED
+    if cmd.startswith("DISPLAY "):
+        return PRIORITY_DISPLAY
+    return PRIORITY_RAW
+
+
+def supersedes(new: str, old: str) -> bool:
+    """
+    Whether sending LED command `new` makes sending `old` pointless. LED SET
+    supersedes every LED command, LED HIGH/LOW only those for the same LED.
+    """
+    new_parts = new.split()
+    old_parts = old.split()
+    if len(new_parts) != 3 or len(old_parts) != 3:
+        return False
+    if new_parts[1] == "SET":
+        return True
+    return (
+        new_parts[1] in LED_STATES
+        and old_parts[1] in LED_STATES
+        and new_parts[2] == old_parts[2]
+    )
+
+
+def describe_frame(frame: bytes) -> bytes:
+    """Readable form of a binary frame for the serial history."""
+    name = OPCODE_NAMES.get(frame[0], b"UNKNOWN")
+    if len(frame) == 1:
+        return b"<" + name + b">"
+    return b"<" + name + b" " + frame[1:].hex().encode() + b">"
+
+
+class LineFramer:
+    """
+    Incrementally splits the bytes received from the serial port into text
+    lines and binary frames. Incomplete lines and frames are kept until the
+    rest of them arrives.
+
+    Garbage, like a stray byte or a frame cut off on reconnect, would look
+    like the start of a text line and swallow every frame up to the next
+    newline. So text that contains control bytes or gets too long is
+    dropped up to the next opcode.
+    """
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        # Number of bytes dropped while resynchronizing
+        self.dropped = 0
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """Append `data` and return all lines and frames completed by it."""
+        self.buffer += data
+        if self.buffer.isascii():
+            # Fast path, there can't be any binary frames
+            end = self.buffer.rfind(b"\n")
+            if end < 0:
+                if len(self.buffer) > MAX_LINE_LENGTH:
+                    self.dropped += len(self.buffer)
+                    self.buffer.clear()
+                return []
+            complete = bytes(self.buffer[:end])
+            del self.buffer[:end + 1]
+            return complete.splitlines()
+
+        buf = self.buffer
+        frames: list[bytes] = []
+        pos = 0
+        while pos < len(buf):
+            if buf[pos] >= 0x80:
+                size = FRAME_SIZES.get(buf[pos])
+                if size is None:
+                    pos += 1  # Line noise or an unknown opcode
+                    continue
+                if pos + size > len(buf):
+                    break
+                frames.append(bytes(buf[pos:pos + size]))
+                pos += size
+            else:
+                limit = min(len(buf), pos + MAX_LINE_LENGTH + 1)
+                end = buf.find(b"\n", pos, limit)
+                if INVALID_TEXT.search(buf, pos, end if end >= 0 else limit):
+                    pos = self._resync(pos)
+                elif end >= 0:
+                    frames.append(bytes(buf[pos:end]).rstrip(b"\r"))
+                    pos = end + 1
+                elif limit - pos > MAX_LINE_LENGTH:
+                    pos = self._resync(pos)
+                else:
+                    break
+        del buf[:pos]
+        return frames
+
+    def _resync(self, pos: int) -> int:
+        """Drop the garbage at `pos`, returns where to continue."""
+        match = KNOWN_OPCODES.search(self.buffer, pos + 1)
+        end = match.start() if match else len(self.buffer)
+        self.dropped += end - pos
+        return end
+
+    def reset(self) -> None:
+        self.buffer.clear()
+
+
+class CommandQueue:
+    """
+    Bounded queue of outbound commands. Commands are taken out by priority
+    class first and in order within a class. LED commands replace queued
+    ones they supersede if `merge` is set. When the queue is full, less
+    important commands are dropped in favor of more important ones, ties are
+    decided by `overflow` (OVERFLOW_DROP_OLDEST or OVERFLOW_DROP_NEWEST).
+    """
+
+    def __init__(
+        self,
+        max_size: int = 256,
+        merge: bool = True,
+        overflow: str = OVERFLOW_DROP_OLDEST,
+    ) -> None:
+        self.max_size = max_size
+        self.merge = merge
+        self.overflow = overflow
+        self.queues: tuple[deque[str], ...] = tuple(
+            deque() for _ in PRIORITY_NAMES
+        )
+        self.size = 0
+        # Commands dropped because the queue was full, per priority class
+        self.dropped = [0] * len(PRIORITY_NAMES)
+        # Commands replaced by a newer one superseding them
+        self.merged = 0
+        # Written to from the GUI and the serial thread
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def put(self, cmd: str, priority: Optional[int] = None) -> list[str]:
+        """
+        Queue `cmd`, with the priority class from command_priority() unless
+        given. Returns the commands dropped to make room, which includes `cmd`
+        itself if it didn't make it into the queue.
+        """
+        if priority is None:
+            priority = command_priority(cmd)
+        with self.lock:
+            queue = self.queues[priority]
+            if self.merge and priority == PRIORITY_LED:
+                # There are only a handful of LED commands left once merged
+                for old in [old for old in queue if supersedes(cmd, old)]:
+                    queue.remove(old)
+                    self.size -= 1
+                    self.merged += 1
+            dropped: list[str] = []
+            if self.size >= self.max_size:
+                victim = self._evict(priority)
+                if victim is None:
+                    self.dropped[priority] += 1
+                    return [cmd]
+                dropped.append(victim)
+            queue.append(cmd)
+            self.size += 1
+            return dropped
+
+    def _evict(self, priority: int) -> Optional[str]:
+        """Drop a command to make room for one of `priority`."""
+        for lowest in reversed(range(priority, len(self.queues))):
+            queue = self.queues[lowest]
+            if not queue:
+                continue
+            if (
+                lowest == priority
+                and self.overflow == OVERFLOW_DROP_NEWEST
+            ):
+                return None
+            self.dropped[lowest] += 1
+            self.size -= 1
+            return queue.popleft()
+        return None
+
+    def take(self, n: int) -> list[tuple[int, str]]:
+        """
+        Remove and return up to `n` commands, most important first, as
+        (priority class, command) pairs.
+        """
+        batch: list[tuple[int, str]] = []
+        with self.lock:
+            for priority, queue in enumerate(self.queues):
+                while queue and len(batch) < n:
+                    batch.append((priority, queue.popleft()))
+            self.size -= len(batch)
+        return batch
+
+    def requeue(self, batch: list[tuple[int, str]]) -> None:
+        """
+        Put commands returned by take() back in front of their priority
+        class, e.g. after a failed write, so they are taken again first and
+        in the same order, and can still be merged or evicted. This may
+        briefly exceed max_size.
+        """
+        with self.lock:
+            for priority, cmd in reversed(batch):
+                self.queues[priority].appendleft(cmd)
+            self.size += len(batch)
+
+    def clear(self) -> None:
+        with self.lock:
+            for queue in self.queues:
+                queue.clear()
+            self.size = 0
+
+    def stats(self) -> str:
+        """Queue depth and drop counts for display."""
+        parts = [f"{self.size} queued"]
+        for name, dropped in zip(PRIORITY_NAMES, self.dropped):
+            if dropped:
+                parts.append(f"{dropped} {name} dropped")
+        if self.merged:
+            parts.append(f"{self.merged} merged")
+        return ", ".join(parts)